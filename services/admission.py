@@ -0,0 +1,140 @@
+"""
+Admission control for the services' prediction requests.
+
+Without a limit, requests that arrive faster than the model can answer them pile up in the server,
+holding memory until their callers time out. With admission control, at most `MIDAS_MAX_IN_FLIGHT`
+POST requests are handled at once, and any more are turned away right away with a 429. Each admitted
+request also has a deadline, after which it is answered with a 503 instead of waiting any longer for
+the model: if it is still waiting for a batch when its deadline passes, it is dropped from the batch
+before the model runs.
+
+Both responses carry a `Retry-After` header with the number of seconds a caller should wait before
+trying again, estimated from an exponentially weighted moving average of recent request latencies.
+Under load, this is about how long the requests ahead of the caller will take to clear.
+
+Configured with environment variables:
+
+    MIDAS_MAX_IN_FLIGHT   the most POST requests handled at once (default 64)
+    MIDAS_DEADLINE_MS     how long a request may take (default 30000), which callers can shorten
+                          for a single request with an `X-Deadline-Ms` header (a request whose
+                          header isn't a positive number is answered with a 400)
+"""
+import json
+import math
+import os
+import threading
+import time
+
+from flask import request
+
+from batching import DeadlineExceeded
+
+# Weight of the latest request in the latency average
+EWMA_ALPHA = 0.2
+
+# Deadline of the request being handled by the current thread
+_local = threading.local()
+
+
+def deadline():
+    """
+    Return the time.monotonic() deadline of the request being handled by this thread, or None if
+    there isn't one (e.g. when a service module is used without going through HTTP).
+    """
+    return getattr(_local, "deadline", None)
+
+
+def check_deadline():
+    """
+    Raise DeadlineExceeded if the request being handled by this thread is past its deadline.
+    """
+    d = deadline()
+    if d is not None and time.monotonic() >= d:
+        raise DeadlineExceeded()
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight: int = None, deadline_ms: float = None):
+        self.max_in_flight = max_in_flight or int(os.environ.get("MIDAS_MAX_IN_FLIGHT", 64))
+        self.deadline_ms = deadline_ms or float(os.environ.get("MIDAS_DEADLINE_MS", 30000))
+        self.in_flight = 0
+        self.latency = None
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+
+    def try_admit(self) -> bool:
+        with self._lock:
+            if self.in_flight >= self.max_in_flight:
+                self.rejected += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self, seconds: float, expired: bool):
+        with self._lock:
+            self.in_flight -= 1
+            if expired:
+                self.expired += 1
+            else:
+                self.latency = seconds if self.latency is None else EWMA_ALPHA * seconds + (1 - EWMA_ALPHA) * self.latency
+
+    def retry_after(self) -> int:
+        """
+        Return a whole number of seconds, at least 1, that a turned away caller should wait.
+        """
+        return max(1, math.ceil(self.latency or 0))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "in_flight": self.in_flight,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "expired": self.expired,
+                "latency_ewma_s": self.latency,
+            }
+
+
+def add_admission_control(app, controller: AdmissionController = None) -> AdmissionController:
+    """
+    Limit the POST requests `app` handles at once and give each of them a deadline.
+    """
+    controller = controller or AdmissionController()
+
+    def unavailable(status: int, message: str):
+        return json.dumps({"error": message}), status, {"Retry-After": str(controller.retry_after())}
+
+    @app.before_request
+    def admit():
+        if request.method != "POST":
+            return None
+        # Read before admitting, so that a bad header can't leave a slot taken
+        try:
+            deadline_ms = float(request.headers.get("X-Deadline-Ms", controller.deadline_ms))
+        except ValueError:
+            deadline_ms = math.nan
+        if not deadline_ms > 0 or math.isinf(deadline_ms):
+            return json.dumps({"error": "X-Deadline-Ms must be a positive number of milliseconds"}), 400
+        if not controller.try_admit():
+            return unavailable(429, f"More than {controller.max_in_flight} requests in flight")
+        _local.began = time.monotonic()
+        _local.deadline = _local.began + min(deadline_ms, controller.deadline_ms) / 1000
+        _local.expired = False
+        return None
+
+    @app.errorhandler(DeadlineExceeded)
+    def expire(e):
+        _local.expired = True
+        return unavailable(503, "The request's deadline passed before it could be answered")
+
+    @app.teardown_request
+    def release(exc):
+        if getattr(_local, "deadline", None) is not None:
+            controller.release(time.monotonic() - _local.began, _local.expired)
+            _local.deadline = None
+
+    return controller
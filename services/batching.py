@@ -0,0 +1,103 @@
+"""
+Coalesces concurrent requests into batched model calls.
+
+Flask handles each request in its own thread, so when several requests arrive at once they would
+each make their own model call. A MicroBatcher instead puts each request's input on a queue, and a
+worker thread collects inputs until it has `max_batch_size` of them or the oldest one has waited
+`max_wait_ms`, makes a single call to `predict_batch` with all of them, and hands each caller back
+its own output.
+
+An input may be given a deadline, in which case it is dropped from its batch with a DeadlineExceeded
+error if the deadline has passed by the time the batch is predicted.
+
+The window is configured with environment variables:
+
+    MIDAS_BATCH_SIZE      the most inputs given to one model call (default 32)
+    MIDAS_BATCH_WAIT_MS   the longest an input waits for others to join its batch (default 5)
+"""
+import os
+import queue
+import threading
+import time
+from typing import Callable, List
+
+import metrics
+from process_thread import ProcessThread
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class _Pending:
+    def __init__(self, item, deadline):
+        self.item = item
+        self.deadline = deadline
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    def __init__(self, predict_batch: Callable[[List], List], max_batch_size: int = None, max_wait_ms: float = None):
+        """
+        `predict_batch` must take a list of inputs and return a list of outputs in the same order.
+        """
+        self.predict_batch = predict_batch
+        self.max_batch_size = max_batch_size or int(os.environ.get("MIDAS_BATCH_SIZE", 32))
+        self.max_wait = (max_wait_ms if max_wait_ms is not None else float(os.environ.get("MIDAS_BATCH_WAIT_MS", 5))) / 1000
+        self._queue = queue.Queue()
+        self._worker = ProcessThread(self._work, reset=self._reset)
+
+    def _reset(self):
+        self._queue = queue.Queue()
+
+    def submit(self, item, deadline: float = None):
+        """
+        Block until `item` has been predicted as part of a batch, and return its output. If `deadline`
+        (a time.monotonic() value) passes before its batch is predicted, raise DeadlineExceeded instead.
+        """
+        self._worker.ensure_started()
+        pending = _Pending(item, deadline)
+        self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _collect(self, q: queue.Queue) -> List[_Pending]:
+        batch = [q.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(q.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self):
+        q = self._queue
+        while True:
+            batch = self._collect(q)
+            now = time.monotonic()
+            for p in batch:
+                if p.deadline is not None and p.deadline <= now:
+                    p.error = DeadlineExceeded()
+                    p.done.set()
+            batch = [p for p in batch if p.error is None]
+            if len(batch) == 0:
+                continue
+            metrics.observe("midas_batch_size", len(batch))
+            try:
+                results = self.predict_batch([p.item for p in batch])
+                for p, result in zip(batch, results):
+                    p.result = result
+            except Exception as e:
+                # Every caller in the batch sees the failure, and the worker goes on to the next batch
+                for p in batch:
+                    p.error = e
+            for p in batch:
+                p.done.set()
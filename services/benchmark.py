@@ -0,0 +1,261 @@
+"""
+Benchmarks for the services.
+
+    python benchmark.py http corpus.conllu --url http://localhost:5555/ --concurrency 8
+    python benchmark.py stages sample_xpos corpus.conllu
+
+`http` replays a corpus against a running service, sending each sentence the way Midas Loop's
+`get-probas` does (its `conllu`, its `json`, its document's `full_conllu`, and its `sentence_index`),
+so the same run works against any service. With `--minimal`, only the inputs the service declares at
+`/capabilities` are sent, and with `--gzip`, request bodies are compressed. It reports latency
+percentiles, sentences and tokens per second, and request and response sizes.
+
+`stages` imports a service module and calls it in process, one sentence at a time, with its cache
+and micro-batching window turned off. It reports the time per sentence, and the time spent in each
+of the stages recorded by `metrics.py`, for each range of sentence lengths.
+
+Without a corpus, both use a synthetic one of `--sentences` sentences of random words, generated from
+`--seed`, so that runs are reproducible on any machine. The random services need no model, so
+`stages random_head` or `http` against `random_head.py` make baselines that catch regressions in
+the code around the models.
+
+Either command can write its results to a JSON file with `--json`, to compare runs.
+"""
+import argparse
+import gzip
+import importlib
+import json
+import os
+import random
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import conllu_reader
+
+# Words for synthetic sentences
+_WORDS = ("the of and a to in is was for that on with as by at from it his an were are which this be "
+          "has had not or their one but after first new who they have two been its also time year "
+          "school city state people house river music film game work team war").split()
+
+
+def synthetic_corpus(n: int, seed: int, max_length: int = 60, document_size: int = 20) -> str:
+    """
+    Return a CoNLL-U corpus of `n` sentences of random words, in documents of `document_size` sentences.
+    """
+    rng = random.Random(seed)
+    sentences = []
+    for i in range(n):
+        lines = [f"# newdoc id = synthetic-{i // document_size}"] if i % document_size == 0 else []
+        lines.append(f"# sent_id = synthetic-{i}")
+        length = min(max_length, 1 + int(rng.expovariate(1 / 18)))
+        for j in range(1, length + 1):
+            form = rng.choice(_WORDS) if j < length else "."
+            lines.append("\t".join([str(j), form] + ["_"] * 8))
+        sentences.append("\n".join(lines))
+    return "\n\n".join(sentences) + "\n"
+
+
+def _read_corpus(args):
+    if args.corpus is not None:
+        with open(args.corpus, encoding="utf-8") as f:
+            return list(conllu_reader.read_sentences(f))
+    return list(conllu_reader.read_sentences(synthetic_corpus(args.sentences, args.seed)))
+
+
+def _n_tokens(sentence: conllu_reader.Sentence) -> int:
+    return len(sentence.forms_of(conllu_reader.TOKEN, conllu_reader.EMPTY))
+
+
+def _percentiles(values) -> dict:
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) if len(values) > 0 else (float("nan"),) * 3
+    return {"p50": p50, "p95": p95, "p99": p99, "max": max(values, default=float("nan"))}
+
+
+def _capabilities(url: str) -> dict:
+    with urllib.request.urlopen(url.rstrip("/") + "/capabilities") as response:
+        return json.load(response)
+
+
+def _requests(sentences, fmt: str, inputs=None, compress: bool = False):
+    """
+    Yield the body of a request for each sentence, along with its number of tokens. If `inputs` is
+    given, only those keys are sent.
+    """
+    for document in conllu_reader.documents(sentences):
+        unit = list(document)
+        full_conllu = "\n\n".join(s.conllu for _, s in unit) + "\n"
+        for j, (_, s) in enumerate(unit):
+            body = {"conllu": s.conllu + "\n", "json": conllu_reader.sentence_json(s), "full_conllu": full_conllu,
+                    "sentence_index": j}
+            if inputs is not None:
+                body = {k: v for k, v in body.items() if k in inputs}
+            if fmt is not None:
+                body["format"] = fmt
+            data = json.dumps(body).encode("utf-8")
+            yield gzip.compress(data) if compress else data, _n_tokens(s)
+
+
+def _post(url: str, body: bytes, compressed: bool):
+    headers = {"Content-Type": "application/json"}
+    if compressed:
+        headers["Content-Encoding"] = "gzip"
+    request = urllib.request.Request(url, data=body, headers=headers)
+    began = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request) as response:
+            status, response_body = response.status, response.read()
+    except urllib.error.HTTPError as e:
+        status, response_body = e.code, e.read()
+    return time.perf_counter() - began, status, len(response_body)
+
+
+def run_http(args) -> dict:
+    inputs = _capabilities(args.url)["inputs"] if args.minimal else None
+    bodies = list(_requests(_read_corpus(args), args.format, inputs, args.gzip)) * args.repeat
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        list(pool.map(lambda b: _post(args.url, b[0], args.gzip), bodies[:args.warmup]))
+        began = time.perf_counter()
+        results = list(pool.map(lambda b: _post(args.url, b[0], args.gzip), bodies))
+        wall = time.perf_counter() - began
+
+    ok = [(r, b) for r, b in zip(results, bodies) if r[1] == 200]
+    statuses = {}
+    for _, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        "url": args.url,
+        "concurrency": args.concurrency,
+        "requests": len(results),
+        "statuses": statuses,
+        "seconds": wall,
+        "sentences_per_second": len(ok) / wall,
+        "tokens_per_second": sum(tokens for _, (_, tokens) in ok) / wall,
+        "latency_ms": {k: v * 1000 for k, v in _percentiles([r[0] for r, _ in ok]).items()},
+        "request_bytes": {"mean": float(np.mean([len(b) for b, _ in bodies])), "total": sum(len(b) for b, _ in bodies)},
+        "response_bytes": {"mean": float(np.mean([r[2] for r, _ in ok])) if ok else None,
+                           "total": sum(r[2] for r, _ in ok)},
+    }
+
+
+def print_http(result: dict):
+    latency = result["latency_ms"]
+    print(f"{result['requests']} requests to {result['url']} at concurrency {result['concurrency']} "
+          f"in {result['seconds']:.2f}s, statuses: {result['statuses']}")
+    print(f"sentences/s  {result['sentences_per_second']:.1f}")
+    print(f"tokens/s     {result['tokens_per_second']:.1f}")
+    print(f"latency ms   p50 {latency['p50']:.2f}  p95 {latency['p95']:.2f}  p99 {latency['p99']:.2f}  "
+          f"max {latency['max']:.2f}")
+    print(f"request      {result['request_bytes']['mean']:.0f} bytes on average")
+    if result["response_bytes"]["mean"] is not None:
+        print(f"response     {result['response_bytes']['mean']:.0f} bytes on average")
+
+
+# How each service module is called on one sentence, mirroring its `/` route
+CALLS = {
+    "sample_xpos": lambda m, s: m.tag_conllu(s.conllu),
+    "sample_head": lambda m, s: m.get_head_probas(conllu_reader.sentence_json(s)),
+    "sample_sentence": lambda m, s: m.ssplit_document(s.conllu),
+    "random_head": lambda m, s: m.get_head_probas(conllu_reader.sentence_json(s)),
+    "random_sentence": lambda m, s: m.random_splits(s.conllu),
+}
+
+
+def _bucket_name(edges, i) -> str:
+    low = edges[i - 1] + 1 if i > 0 else 1
+    return f"{low}-{edges[i]}" if i < len(edges) else f"{low}+"
+
+
+def run_stages(args) -> dict:
+    # Every call should do all of its work, alone, with no wait for other inputs to batch with
+    os.environ["MIDAS_CACHE_BYTES"] = "0"
+    os.environ.pop("MIDAS_CACHE_DIR", None)
+    os.environ["MIDAS_BATCH_WAIT_MS"] = "0"
+    import metrics
+    module = importlib.import_module(args.module)
+    if hasattr(module, "LOADER"):
+        module.LOADER.wait()
+    call = CALLS[args.module]
+
+    edges = sorted(int(e) for e in args.buckets.split(","))
+    buckets = [[] for _ in range(len(edges) + 1)]
+    for s in _read_corpus(args):
+        buckets[np.searchsorted(edges, _n_tokens(s))].append(s)
+
+    for s in buckets[0][:args.warmup]:
+        metrics.dumps(call(module, s))
+    results = []
+    for i, sentences in enumerate(buckets):
+        if len(sentences) == 0:
+            continue
+        metrics.reset()
+        times = []
+        for _ in range(args.repeat):
+            for s in sentences:
+                began = time.perf_counter()
+                metrics.dumps(call(module, s))
+                times.append(time.perf_counter() - began)
+        results.append({
+            "tokens": _bucket_name(edges, i),
+            "sentences": len(sentences),
+            "mean_tokens": float(np.mean([_n_tokens(s) for s in sentences])),
+            "ms": {k: v * 1000 for k, v in _percentiles(times).items()},
+            "mean_ms": float(np.mean(times)) * 1000,
+            "stage_ms": {stage: seconds * 1000 / len(times) for stage, (seconds, _) in metrics.stage_totals().items()},
+        })
+    return {"module": args.module, "buckets": results}
+
+
+def print_stages(result: dict):
+    stages = sorted({stage for b in result["buckets"] for stage in b["stage_ms"]})
+    print(f"Milliseconds per sentence for {result['module']}")
+    print("  ".join(f"{h:>9}" for h in ["tokens", "sentences", "mean", "p95"] + stages))
+    for b in result["buckets"]:
+        cells = [b["tokens"], str(b["sentences"]), f"{b['mean_ms']:.3f}", f"{b['ms']['p95']:.3f}"]
+        cells += [f"{b['stage_ms'].get(stage, 0.0):.3f}" for stage in stages]
+        print("  ".join(f"{c:>9}" for c in cells))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the services.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_common(p):
+        p.add_argument("corpus", nargs="?", default=None, help="CoNLL-U file to send (default: a synthetic corpus)")
+        p.add_argument("--sentences", type=int, default=500, help="size of the synthetic corpus (default: %(default)s)")
+        p.add_argument("--seed", type=int, default=0, help="seed of the synthetic corpus (default: %(default)s)")
+        p.add_argument("--repeat", type=int, default=1, help="times to go through the corpus (default: %(default)s)")
+        p.add_argument("--warmup", type=int, default=10, help="unmeasured calls made first (default: %(default)s)")
+        p.add_argument("--json", default=None, help="file to write the results to")
+
+    http = subparsers.add_parser("http", help="replay a corpus against a running service")
+    http.add_argument("--url", default="http://localhost:5555/", help="service URL (default: %(default)s)")
+    http.add_argument("--concurrency", type=int, default=4, help="requests in flight at once (default: %(default)s)")
+    http.add_argument("--format", default=None, choices=["json", "compact"], help="response format to request")
+    http.add_argument("--minimal", action="store_true", help="only send the inputs the service declares it reads")
+    http.add_argument("--gzip", action="store_true", help="gzip request bodies")
+    add_common(http)
+
+    stages = subparsers.add_parser("stages", help="time each stage of a service module in process")
+    stages.add_argument("module", choices=sorted(CALLS), help="service module to benchmark")
+    stages.add_argument("--buckets", default="10,20,40,80",
+                        help="upper bounds of the sentence length ranges, in tokens (default: %(default)s)")
+    add_common(stages)
+
+    args = parser.parse_args(argv)
+    if args.command == "http":
+        result = run_http(args)
+        print_http(result)
+    else:
+        result = run_stages(args)
+        print_stages(result)
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
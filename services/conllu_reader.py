@@ -0,0 +1,108 @@
+"""
+A minimal CoNLL-U reader for the services.
+
+The services only need each token's ID, form, and what kind of token it is, plus a few metadata values
+such as `sent_id`, so this reader does a single pass over the lines of its input and skips
+everything else that `conllu.parse` would build (token dicts, features, heads, and so on).
+Sentences are yielded one at a time, so large documents and files can be streamed.
+
+Also provides the helpers that tools reading a corpus offline share: `documents` groups a stream of
+sentences into documents, and `sentence_json` stands in for Midas Loop's json representation of a
+sentence where a service's function expects it.
+"""
+import itertools
+import re
+from typing import Iterable, Iterator, List, NamedTuple, Tuple, Union
+
+# Token kinds, named as in Midas Loop's `token/token-type`
+TOKEN = "token"
+SUPER = "super"
+EMPTY = "empty"
+
+# Like `conllu`, accept runs of two or more spaces as a field separator if there are no tabs
+_SPACES = re.compile(r" {2,}")
+
+
+class Sentence(NamedTuple):
+    metadata: dict
+    ids: List[str]
+    forms: List[str]
+    kinds: List[str]
+    # The sentence's lines, as given
+    conllu: str
+
+    def forms_of(self, *kinds: str) -> List[str]:
+        """
+        Return the forms of the tokens whose kind is one of `kinds`.
+        """
+        return [form for form, kind in zip(self.forms, self.kinds) if kind in kinds]
+
+
+def _kind(token_id: str) -> str:
+    if "-" in token_id:
+        return SUPER
+    if "." in token_id:
+        return EMPTY
+    return TOKEN
+
+
+def read_sentences(source: Union[str, Iterable[str]]) -> Iterator[Sentence]:
+    """
+    Yield each sentence in `source`, which is either a CoNLL-U string or an iterable of lines,
+    such as an open file.
+    """
+    # Not splitlines(), which also splits on characters like U+2028 that can be part of a form
+    lines = source.split("\n") if isinstance(source, str) else source
+    metadata, ids, forms, kinds, raw = {}, [], [], [], []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        if line.strip() == "":
+            if len(raw) > 0:
+                yield Sentence(metadata, ids, forms, kinds, "\n".join(raw))
+                metadata, ids, forms, kinds, raw = {}, [], [], [], []
+            continue
+        raw.append(line)
+        if line.startswith("#"):
+            key, sep, value = line[1:].partition("=")
+            metadata[key.strip()] = value.strip() if sep else None
+        else:
+            fields = line.split("\t", 2) if "\t" in line else _SPACES.split(line, 2)
+            ids.append(fields[0])
+            kinds.append(_kind(fields[0]))
+            forms.append(fields[1])
+    if len(raw) > 0:
+        yield Sentence(metadata, ids, forms, kinds, "\n".join(raw))
+
+
+def is_new_document(sentence: Sentence) -> bool:
+    return "newdoc id" in sentence.metadata or "newdoc" in sentence.metadata
+
+
+def documents(sentences: Iterable[Sentence]) -> Iterator[Iterator[Tuple[int, Sentence]]]:
+    """
+    Group `sentences` into documents, each of which begins with a `newdoc id` comment, and yield each
+    document as an iterator over its (sentence index, sentence) pairs. As with `itertools.groupby`,
+    a document's iterator can no longer be used once the next document is taken, so that a long
+    document never has to be held in memory.
+    """
+    n_documents = 0
+
+    def document_of(pair):
+        nonlocal n_documents
+        if is_new_document(pair[1]):
+            n_documents += 1
+        return n_documents
+
+    for _, document in itertools.groupby(enumerate(sentences), key=document_of):
+        yield document
+
+
+def sentence_json(sentence: Sentence) -> dict:
+    """
+    Make the parts of Midas Loop's json representation of a sentence that `get_head_probas` reads,
+    with CoNLL-U IDs standing in for token UUIDs.
+    """
+    return {"sentence/tokens": [
+        {"token/id": token_id, "token/token-type": kind, "token/form": {"form/value": form}}
+        for token_id, form, kind in zip(sentence.ids, sentence.forms, sentence.kinds)
+    ]}
@@ -0,0 +1,128 @@
+"""
+An optional CPU inference mode for the torch models in sample_head.py and sample_sentence.py.
+
+With `MIDAS_CPU_INFERENCE=1`, when a service loads its model:
+
+* torch is given an explicit number of intra-op threads (`MIDAS_THREADS`, or one per core) and a
+  single inter-op thread, since requests are already run concurrently by batching and workers
+* the model's Linear and LSTM layers are replaced with dynamically quantized int8 versions, whose
+  weights take a quarter of the memory and whose matrix multiplications are faster on CPUs
+
+Quantization changes the model's probabilities a little. To measure how much, the fp32 and int8
+models are both run on the same sentences: the module's bundled sample, or the first
+`MIDAS_CPU_CHECK_SENTENCES` (default 100) sentences of the CoNLL-U file at `MIDAS_CPU_CHECK_CONLLU`.
+For each token, the drift is the total variation distance between its fp32 and int8 distributions
+(half the sum of absolute differences). If the mean drift is above `MIDAS_CPU_MAX_DRIFT` (default
+0.02), the int8 model is discarded and the service keeps running in fp32. The comparison, including
+how often both models agree on each token's most probable label and how much faster int8 was, is
+written to stderr and kept in `last_check`. A service that keeps the int8 model adds `INT8_SUFFIX` to
+the model ID its predictions are cached under, so that a persistent store never mixes them with fp32 ones.
+
+Whether or not the mode is on, models are run under `inference()`, which turns off autograd.
+"""
+import os
+import sys
+import time
+from contextlib import contextmanager
+from itertools import islice
+from typing import Callable, List
+
+import numpy as np
+
+import conllu_reader
+
+ENABLED = os.environ.get("MIDAS_CPU_INFERENCE", "0") not in ("", "0", "false")
+MAX_DRIFT = float(os.environ.get("MIDAS_CPU_MAX_DRIFT", 0.02))
+INT8_SUFFIX = "+int8"
+
+# The comparison made by the last call to `quantize`
+last_check = None
+
+
+@contextmanager
+def inference():
+    """
+    Run torch without autograd, using inference mode where this version of torch has it.
+    """
+    import torch
+    with (torch.inference_mode() if hasattr(torch, "inference_mode") else torch.no_grad()):
+        yield
+
+
+def configure_threads():
+    import torch
+    import serving
+    serving.limit_threads(int(os.environ.get("MIDAS_THREADS", os.cpu_count() or 1)))
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # Can only be set before torch first runs anything in parallel
+        pass
+
+
+def check_sentences(default: List[List[str]]) -> List[List[str]]:
+    """
+    Return the token forms of the sentences to compare fp32 and int8 outputs on, which are `default`
+    unless MIDAS_CPU_CHECK_CONLLU is set.
+    """
+    path = os.environ.get("MIDAS_CPU_CHECK_CONLLU")
+    if not path:
+        return default
+    n = int(os.environ.get("MIDAS_CPU_CHECK_SENTENCES", 100))
+    with open(path, encoding="utf-8") as f:
+        return [s.forms_of(conllu_reader.TOKEN) for s in islice(conllu_reader.read_sentences(f), n)]
+
+
+def _quantize_dynamic(module):
+    import torch
+    try:
+        from torch.ao.quantization import quantize_dynamic
+    except ImportError:
+        from torch.quantization import quantize_dynamic
+    return quantize_dynamic(module, {torch.nn.Linear, torch.nn.LSTM}, dtype=torch.qint8)
+
+
+def compare(fp32: List[np.ndarray], int8: List[np.ndarray]) -> dict:
+    """
+    Compare two models' (n_tokens, n_labels) probability matrices for the same sentences.
+    """
+    fp32 = np.concatenate([np.asarray(m, dtype=np.float64) for m in fp32])
+    int8 = np.concatenate([np.asarray(m, dtype=np.float64) for m in int8])
+    drift = 0.5 * np.abs(fp32 - int8).sum(axis=1)
+    return {
+        "tokens": len(drift),
+        "mean_drift": float(drift.mean()) if len(drift) > 0 else 0.0,
+        "max_drift": float(drift.max()) if len(drift) > 0 else 0.0,
+        "argmax_agreement": float((fp32.argmax(axis=1) == int8.argmax(axis=1)).mean()) if len(drift) > 0 else 1.0,
+    }
+
+
+def quantize(owner, attribute: str, predict: Callable[[List[List[str]]], List[np.ndarray]], sentences: List[List[str]]) -> bool:
+    """
+    Replace the torch module at `owner.<attribute>` with a dynamically quantized int8 copy if its
+    outputs stay close enough to the fp32 module's. `predict` must run whatever module is at
+    `owner.<attribute>` on a list of sentences' token forms and return a probability matrix for each.
+    Return whether the int8 module was kept.
+    """
+    global last_check
+    fp32_module = getattr(owner, attribute)
+    # Each model's first call is slower than the rest, so make it before timing them
+    predict(sentences[:1])
+    began = time.perf_counter()
+    fp32 = predict(sentences)
+    fp32_seconds = time.perf_counter() - began
+
+    setattr(owner, attribute, _quantize_dynamic(fp32_module))
+    predict(sentences[:1])
+    began = time.perf_counter()
+    int8 = predict(sentences)
+    int8_seconds = time.perf_counter() - began
+
+    last_check = compare(fp32, int8)
+    last_check["speedup"] = fp32_seconds / int8_seconds if int8_seconds > 0 else None
+    last_check["kept"] = last_check["mean_drift"] <= MAX_DRIFT
+    sys.stderr.write(f"int8 vs fp32 on {len(sentences)} sentences: {last_check}\n")
+    if not last_check["kept"]:
+        sys.stderr.write(f"Mean drift is above MIDAS_CPU_MAX_DRIFT={MAX_DRIFT}, keeping the fp32 model\n")
+        setattr(owner, attribute, fp32_module)
+    return last_check["kept"]
@@ -0,0 +1,119 @@
+"""
+Encodings for the probability tables that services return.
+
+By default, a service responds with one `{label: probability}` dict per token, which is what Midas Loop
+expects. A caller may instead ask for the compact encoding by including `"format": "compact"` in its
+request, in which case the labels are sent once and the probabilities are sent as a base64-encoded,
+row-major, little-endian float32 matrix:
+
+    {"format": "compact",
+     "dtype": "<f4",
+     "labels": ["NN", "JJ", ...],
+     "probabilities": {"shape": [n_tokens, n_labels], "data": "AACAPwAAAAA..."}}
+
+Endpoints that return several tables at once put a `{"shape": ..., "data": ...}` object wherever the
+default encoding would put a list of dicts.
+
+Tables truncated to each token's k most probable labels (see `encode_top_k`) also carry the
+probability mass left out for each token under `residuals`. In the compact encoding, they send an
+int32 matrix of label indexes under `indices` alongside the probabilities.
+"""
+import base64
+from typing import List
+
+import numpy as np
+from werkzeug.exceptions import BadRequest
+
+import metrics
+
+JSON = "json"
+COMPACT = "compact"
+DTYPE = "<f4"
+
+
+def request_format(data: dict) -> str:
+    """
+    Return the response format a request asks for, or answer it with a 400 if it is unknown.
+    """
+    fmt = data.get("format", JSON)
+    if fmt not in (JSON, COMPACT):
+        raise BadRequest(f"Unknown format {fmt!r}, expected {JSON!r} or {COMPACT!r}")
+    return fmt
+
+
+@metrics.timed("encode")
+def to_dicts(matrix, labels: List[str]) -> List[dict]:
+    """
+    Turn an (n_tokens, n_labels) matrix into one {label: probability} dict per token. Converting the
+    whole matrix with `tolist` is much faster than boxing each numpy float on its own.
+    """
+    return [dict(zip(labels, row)) for row in np.asarray(matrix, dtype=np.float64).tolist()]
+
+
+@metrics.timed("encode")
+def pack(matrix) -> dict:
+    matrix = np.ascontiguousarray(matrix, dtype=DTYPE)
+    return {"shape": list(matrix.shape), "data": base64.b64encode(matrix.tobytes()).decode("ascii")}
+
+
+def unpack(packed: dict) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(packed["data"]), dtype=DTYPE).reshape(packed["shape"])
+
+
+def encode(matrix, labels: List[str], fmt: str) -> dict:
+    """
+    Return the response body for a single probability table in the requested format.
+    """
+    if fmt == COMPACT:
+        return {"format": COMPACT, "dtype": DTYPE, "labels": list(labels), "probabilities": pack(matrix)}
+    return {"probabilities": to_dicts(matrix, labels)}
+
+
+def encode_many(matrices, labels: List[str], fmt: str) -> dict:
+    """
+    Return the response body for several probability tables that share their labels.
+    """
+    if fmt == COMPACT:
+        return {"format": COMPACT, "dtype": DTYPE, "labels": list(labels), "probabilities": [pack(m) for m in matrices]}
+    return {"probabilities": [to_dicts(m, labels) for m in matrices]}
+
+
+def top_k(matrix, k: int):
+    """
+    Return the column indexes and values of the k largest entries of each row of `matrix`, in
+    descending order, along with the mass of each row left outside of them.
+    """
+    matrix = np.asarray(matrix, dtype=np.float64)
+    k = min(k, matrix.shape[1])
+    indices = np.argpartition(-matrix, k - 1, axis=1)[:, :k]
+    values = np.take_along_axis(matrix, indices, axis=1)
+    order = np.argsort(-values, axis=1, kind="stable")
+    indices = np.take_along_axis(indices, order, axis=1)
+    values = np.take_along_axis(values, order, axis=1)
+    residuals = np.maximum(matrix.sum(axis=1) - values.sum(axis=1), 0.0)
+    return indices, values, residuals
+
+
+@metrics.timed("encode")
+def top_k_dicts(indices, values, labels: List[str]) -> List[dict]:
+    return [
+        {labels[i]: v for i, v in zip(row_indices, row_values)}
+        for row_indices, row_values in zip(indices.tolist(), values.tolist())
+    ]
+
+
+def encode_top_k(matrix, labels: List[str], k: int, fmt: str) -> dict:
+    """
+    Like `encode`, but only keep the k most probable labels of each token.
+    """
+    indices, values, residuals = top_k(matrix, k)
+    if fmt == COMPACT:
+        return {
+            "format": COMPACT,
+            "dtype": DTYPE,
+            "labels": list(labels),
+            "indices": {"shape": list(indices.shape), "data": base64.b64encode(indices.astype("<i4").tobytes()).decode("ascii")},
+            "probabilities": pack(values),
+            "residuals": residuals.tolist(),
+        }
+    return {"probabilities": top_k_dicts(indices, values, labels), "residuals": residuals.tolist()}
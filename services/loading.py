@@ -0,0 +1,159 @@
+"""
+Loads a service's model in a background thread, so that the service can answer health checks while
+its model loads instead of refusing connections.
+
+Once the model is loaded, a warm-up inference is run on the service's bundled sample so that lazy
+initialization (thread pools, allocator arenas, first-call code paths) is paid before any real
+request arrives. A service is ready once its warm-up is done. Readiness is per process: a worker
+forked from a process that already loaded the model reuses it, but runs its own warm-up.
+
+`add_probes` adds two endpoints to a service's app:
+
+    GET /health   200 while the process is up, or 500 if loading the model failed
+    GET /ready    200 once the model is loaded and warmed up, and 503 until then
+
+Until the service is ready, POST requests get a 503 with a `Retry-After` header. Loading starts at
+the first request a process gets, if nothing started it before (as `serving.serve` does), so that
+services also load their model when run by `flask run`, gunicorn, or another WSGI server.
+"""
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+from typing import Callable
+
+from flask import request
+
+from process_thread import ProcessThread
+
+# Seconds a caller is asked to wait before retrying a request made while the model is loading
+RETRY_AFTER = 1
+
+LOADING = "loading"
+WARMING_UP = "warming up"
+READY = "ready"
+FAILED = "failed"
+
+
+def batched_warm_up(batcher, sample: Callable[[], object]) -> Callable[[], None]:
+    """
+    Return a warm-up that submits `sample()` to a service's MicroBatcher. It goes through the batcher,
+    but not the prediction cache, so that the model really runs.
+    """
+    def warm_up():
+        batcher.submit(sample())
+    return warm_up
+
+
+class ModelLoader:
+    def __init__(self, load: Callable[[], None], warm_up: Callable[[], None] = None):
+        """
+        `load` loads the model into the service module's globals, and `warm_up` runs an inference
+        with it that must not go through the prediction cache.
+        """
+        self.load = load
+        self.warm_up = warm_up
+        self.loaded = False
+        self.error = None
+        self._ready_pid = None
+        self._thread = ProcessThread(self._run, reset=self._reset)
+        self._load_lock = threading.Lock()
+        self._changed = threading.Condition()
+
+    @property
+    def ready(self) -> bool:
+        return self._ready_pid == os.getpid()
+
+    def status(self) -> str:
+        if self.error is not None:
+            return FAILED
+        if self.ready:
+            return READY
+        return WARMING_UP if self.loaded else LOADING
+
+    def start(self):
+        """
+        Start loading and warming up the model in a background thread, unless this process already has.
+        """
+        self._thread.ensure_started()
+
+    def _reset(self):
+        self._changed = threading.Condition()
+        # Held forever if the process was forked while another thread was loading
+        self._load_lock = threading.Lock()
+
+    def _load(self):
+        with self._load_lock:
+            if not self.loaded:
+                began = time.monotonic()
+                self.load()
+                self.loaded = True
+                sys.stderr.write(f"Loaded model in {time.monotonic() - began:.1f}s\n")
+
+    def _run(self):
+        try:
+            self._load()
+            self._notify()
+            if self.warm_up is not None:
+                began = time.monotonic()
+                self.warm_up()
+                sys.stderr.write(f"Warmed up model in {time.monotonic() - began:.1f}s\n")
+            self._ready_pid = os.getpid()
+        except Exception as e:
+            traceback.print_exc()
+            self.error = e
+        self._notify()
+
+    def _notify(self):
+        with self._changed:
+            self._changed.notify_all()
+
+    def load_now(self):
+        """
+        Load the model in this thread, without warming it up, unless it is already loaded. Raise a
+        RuntimeError if it could not be loaded.
+        """
+        try:
+            self._load()
+        except Exception as e:
+            self.error = e
+            raise RuntimeError("The model could not be loaded") from e
+
+    def wait(self, timeout: float = None) -> bool:
+        """
+        Start the model if needed and block until it is ready or `timeout` seconds have passed.
+        Return whether it is ready, or raise a RuntimeError if it could not be loaded.
+        """
+        self.start()
+        with self._changed:
+            self._changed.wait_for(lambda: self.ready or self.error is not None, timeout)
+        if self.error is not None:
+            raise RuntimeError("The model could not be loaded") from self.error
+        return self.ready
+
+
+def add_probes(app, loader: ModelLoader = None):
+    """
+    Add `/health` and `/ready` to `app`, and turn away POST requests until `loader`'s model is ready.
+    Without a loader, the service is always ready.
+    """
+
+    @app.route("/health", methods=["GET"])
+    def health():
+        if loader is not None and loader.error is not None:
+            return json.dumps({"status": FAILED, "error": repr(loader.error)}), 500
+        return json.dumps({"status": "ok"})
+
+    @app.route("/ready", methods=["GET"])
+    def ready():
+        status = READY if loader is None else loader.status()
+        return json.dumps({"status": status}), 200 if status == READY else 503
+
+    if loader is not None:
+        @app.before_request
+        def require_ready():
+            loader.start()
+            if request.method == "POST" and not loader.ready:
+                return json.dumps({"status": loader.status()}), 503, {"Retry-After": str(RETRY_AFTER)}
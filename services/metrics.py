@@ -0,0 +1,287 @@
+"""
+Instrumentation for the services, exposed at `GET /metrics` in Prometheus' text format.
+
+Services record what they do with `inc`, `observe`, and the `timer`/`timed` helpers, which put the
+time spent in each stage of handling a request into the `midas_stage_seconds` histogram. The stages are:
+
+    read        reading CoNLL-U into token forms
+    inference   running the model on a batch of inputs
+    clamp       clamping the parser's head probabilities (head service)
+    normalize   normalizing the tagger's scores (xpos service)
+    encode      turning probability matrices into dicts or packed arrays
+    serialize   json.dumps of the response
+
+`add_metrics` adds the `/metrics` endpoint, counts and times requests, and reports the service's
+prediction cache, admission control, and memory use at each scrape.
+
+If `MIDAS_PROFILE_HZ` is set, a thread also samples every thread's stack that many times a second.
+`GET /profile` returns the samples as folded stacks, one `frame;frame;...;frame count` line per
+distinct stack, which flamegraph.pl and speedscope read. `GET /profile?reset=1` also clears them.
+
+Metrics are kept per process, so with `MIDAS_WORKERS` > 1, each scrape reports the worker that
+answered it.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import Response, g, request
+
+from process_thread import ProcessThread
+
+TIME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+# Metrics that services record, as name: (type, help, histogram buckets)
+METRICS = {
+    "midas_requests_total": ("counter", "HTTP requests handled, by route and status code", None),
+    "midas_request_seconds": ("histogram", "Time taken to handle a request, by route", TIME_BUCKETS),
+    "midas_stage_seconds": ("histogram", "Time spent in each stage of handling requests", TIME_BUCKETS),
+    "midas_tokens_total": ("counter", "Tokens read from requests", None),
+    "midas_batch_size": ("histogram", "Inputs given to each model call", SIZE_BUCKETS),
+}
+
+_lock = threading.Lock()
+# (name, labels) -> value
+_counters = defaultdict(float)
+# (name, labels) -> [count in each bucket and above the last, sum, count]
+_histograms = {}
+
+
+def _labels(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def inc(name: str, value: float = 1, **labels):
+    with _lock:
+        _counters[name, _labels(labels)] += value
+
+
+def observe(name: str, value: float, **labels):
+    buckets = METRICS[name][2]
+    i = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+    with _lock:
+        histogram = _histograms.setdefault((name, _labels(labels)), [[0] * (len(buckets) + 1), 0.0, 0])
+        histogram[0][i] += 1
+        histogram[1] += value
+        histogram[2] += 1
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def stage_totals() -> dict:
+    """
+    Return the total seconds and number of timings recorded for each stage, as {stage: (seconds, count)}.
+    """
+    with _lock:
+        return {
+            dict(labels)["stage"]: (h[1], h[2])
+            for (name, labels), h in _histograms.items() if name == "midas_stage_seconds"
+        }
+
+
+@contextmanager
+def timer(stage: str):
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe("midas_stage_seconds", time.perf_counter() - began, stage=stage)
+
+
+def timed(stage: str):
+    """
+    Decorate a function to time each of its calls as `stage`.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return f(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def dumps(obj) -> str:
+    """
+    json.dumps, timed as the `serialize` stage.
+    """
+    with timer("serialize"):
+        return json.dumps(obj)
+
+
+def torch_bytes(module) -> int:
+    """
+    Return the memory held by a torch module's weights. They are read from its state dict rather than
+    its parameters, which leave out the packed weights of quantized layers.
+    """
+    def size(value):
+        if isinstance(value, (tuple, list)):
+            return sum(size(v) for v in value)
+        if hasattr(value, "element_size"):
+            return value.numel() * value.element_size()
+        return 0
+    return sum(size(value) for value in module.state_dict().values())
+
+
+def _resident_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _sample(name: str, labels: tuple, value) -> str:
+    if len(labels) == 0:
+        return f"{name} {value}"
+    return name + "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}" + f" {value}"
+
+
+def _header(name: str, kind: str, help_text: str) -> list:
+    return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+
+def render(extra: list = ()) -> str:
+    """
+    Return every recorded metric, followed by `extra` (name, type, help, value) gauges and counters,
+    in Prometheus' text format.
+    """
+    with _lock:
+        counters = dict(_counters)
+        histograms = {key: (list(h[0]), h[1], h[2]) for key, h in _histograms.items()}
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        if kind == "counter":
+            samples = sorted((labels, v) for (n, labels), v in counters.items() if n == name)
+            if len(samples) > 0:
+                lines += _header(name, kind, help_text)
+                lines += [_sample(name, labels, v) for labels, v in samples]
+        else:
+            samples = sorted((labels, h) for (n, labels), h in histograms.items() if n == name)
+            if len(samples) > 0:
+                lines += _header(name, kind, help_text)
+            for labels, (counts, total, count) in samples:
+                cumulative = 0
+                for bound, c in zip(list(buckets) + ["+Inf"], counts):
+                    cumulative += c
+                    lines.append(_sample(name + "_bucket", labels + (("le", bound),), cumulative))
+                lines.append(_sample(name + "_sum", labels, total))
+                lines.append(_sample(name + "_count", labels, count))
+    for name, kind, help_text, value in extra:
+        if value is not None:
+            lines += _header(name, kind, help_text)
+            lines.append(_sample(name, (), value))
+    return "\n".join(lines) + "\n"
+
+
+class _Sampler:
+    """
+    Samples the stacks of every thread in the process `hz` times a second.
+    """
+
+    def __init__(self, hz: float):
+        self.interval = 1 / hz
+        self.stacks = Counter()
+        self._lock = threading.Lock()
+        # Each process samples its own threads
+        self._thread = ProcessThread(self._run, reset=self._reset)
+
+    def ensure_started(self):
+        self._thread.ensure_started()
+
+    def _reset(self):
+        with self._lock:
+            self.stacks = Counter()
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                with self._lock:
+                    self.stacks[";".join(reversed(stack))] += 1
+
+    def folded(self, reset: bool) -> str:
+        with self._lock:
+            stacks = self.stacks
+            if reset:
+                self.stacks = Counter()
+        return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+
+def add_metrics(app, cache=None, admission=None, model_bytes=None):
+    """
+    Add `/metrics` (and `/profile`, if MIDAS_PROFILE_HZ is set) to `app` and record its requests.
+    `cache` and `admission` are the service's LRUCache and AdmissionController, and `model_bytes`
+    a function returning the memory held by its model's weights, or None if it isn't loaded.
+    """
+    hz = float(os.environ.get("MIDAS_PROFILE_HZ", 0))
+    sampler = _Sampler(hz) if hz > 0 else None
+
+    @app.before_request
+    def start_timer():
+        g.metrics_began = time.perf_counter()
+        if sampler is not None:
+            sampler.ensure_started()
+
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        inc("midas_requests_total", route=route, status=response.status_code)
+        began = g.get("metrics_began")
+        if began is not None:
+            observe("midas_request_seconds", time.perf_counter() - began, route=route)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def get_metrics():
+        extra = [("midas_process_resident_bytes", "gauge", "Resident memory of this process", _resident_bytes())]
+        if model_bytes is not None:
+            extra.append(("midas_model_bytes", "gauge", "Memory held by the model's weights", model_bytes()))
+        if cache is not None:
+            stats = cache.stats()
+            extra += [
+                ("midas_cache_hits_total", "counter", "Prediction cache hits", stats["hits"]),
+                ("midas_cache_misses_total", "counter", "Prediction cache misses", stats["misses"]),
+                ("midas_cache_store_hits_total", "counter", "Prediction cache misses found on disk", stats["store_hits"]),
+                ("midas_cache_evictions_total", "counter", "Predictions evicted from the cache", stats["evictions"]),
+                ("midas_cache_hit_ratio", "gauge", "Fraction of cache lookups that were hits", stats["hit_rate"]),
+                ("midas_cache_entries", "gauge", "Predictions in the cache", stats["entries"]),
+                ("midas_cache_bytes", "gauge", "Approximate size of the predictions in the cache", stats["bytes"]),
+            ]
+        if admission is not None:
+            stats = admission.stats()
+            extra += [
+                ("midas_in_flight_requests", "gauge", "Requests being handled", stats["in_flight"]),
+                ("midas_rejected_requests_total", "counter", "Requests turned away with a 429", stats["rejected"]),
+                ("midas_expired_requests_total", "counter", "Requests that passed their deadline", stats["expired"]),
+                ("midas_latency_ewma_seconds", "gauge", "Moving average of request latency", stats["latency_ewma_s"]),
+            ]
+        return Response(render(extra), mimetype="text/plain; version=0.0.4")
+
+    if sampler is not None:
+        @app.route("/profile", methods=["GET"])
+        def get_profile():
+            return Response(sampler.folded(request.args.get("reset") == "1"), mimetype="text/plain")
@@ -0,0 +1,192 @@
+"""
+Pre-annotate a CoNLL-U corpus offline with the sample services' models, without going through HTTP.
+
+    python preannotate.py corpus.conllu predictions.ndjson --tasks xpos,head,sentence --workers 4
+
+Sentences are streamed from the input and handed out in units to a pool of worker processes, each of
+which loads its own copy of the models it needs. A unit is a chunk of `--chunk-size` sentences. If
+sentence splitting was requested, units never span two documents (split on `newdoc id`), since the
+splitter needs document context: a document of up to `--chunk-size` sentences is a unit of its own,
+and a longer one is cut into chunks that also hold `--context` sentences before and after them, which
+the splitter sees but which are annotated by their own chunk. The splitter's probabilities near a cut
+can differ slightly from those it would give for the whole document. Only a bounded number of units
+are in flight at once, so memory use does not grow with the size of the corpus or of its documents.
+
+The output has one JSON object per input sentence, in input order:
+
+    {"sentence_index": 0, "sent_id": "doc-1", "xpos": [...], "head": [...], "sentence": [...]}
+
+where each task's value is what the corresponding service would respond with under `probabilities`.
+Head labels are the sentence's CoNLL-U token IDs rather than Midas Loop UUIDs.
+
+After every unit, the number of units written and the output's length are saved to a checkpoint
+file. If the same command is run again, it resumes after the last completed unit.
+"""
+import argparse
+import importlib
+import itertools
+import json
+import multiprocessing
+import os
+import sys
+from collections import deque
+
+import conllu_reader
+
+# Module implementing each task
+TASKS = {
+    "xpos": "sample_xpos",
+    "head": "sample_head",
+    "sentence": "sample_sentence",
+}
+
+# The service modules loaded in this worker process, by task
+_modules = {}
+
+
+def _init_worker(tasks):
+    for task in tasks:
+        _modules[task] = importlib.import_module(TASKS[task])
+        # Load the model now rather than in the middle of the first unit
+        _modules[task].LOADER.wait()
+
+
+def _annotate(unit):
+    """
+    Run every loaded task on a unit of (sentence index, sentence) pairs and return one NDJSON line
+    per sentence.
+    """
+    # Context sentences, whose index is None, are only given to the splitter
+    annotated = [(i, s) for i, s in unit if i is not None]
+    records = [{"sentence_index": i, "sent_id": s.metadata.get("sent_id")} for i, s in annotated]
+    if "xpos" in _modules:
+        for record, probas in zip(records, _modules["xpos"].tag_conllu_batch([s.conllu for _, s in annotated])):
+            record["xpos"] = probas
+    if "head" in _modules:
+        for record, probas in zip(records, _modules["head"].get_head_probas_batch([conllu_reader.sentence_json(s) for _, s in annotated])):
+            record["head"] = probas
+    if "sentence" in _modules:
+        document = "\n\n".join(s.conllu for _, s in unit) + "\n"
+        results = _modules["sentence"].ssplit_document(document)
+        for record, result in zip(records, [r for (i, _), r in zip(unit, results) if i is not None]):
+            record["sentence"] = result["probabilities"]
+    return "".join(json.dumps(record) + "\n" for record in records)
+
+
+def _document_chunks(document, chunk_size: int, context: int):
+    """
+    Cut a document's (sentence index, sentence) pairs into units of `chunk_size` sentences, each with
+    up to `context` sentences of the chunks around it, whose index is None.
+    """
+    window = deque()
+    before = []
+    for pair in document:
+        window.append(pair)
+        if len(window) == chunk_size + context:
+            chunk = [window.popleft() for _ in range(chunk_size)]
+            yield before + chunk + [(None, s) for _, s in window]
+            before = [(None, s) for _, s in chunk[max(0, chunk_size - context):]]
+    if len(window) > 0:
+        yield before + list(window)
+
+
+def _units(sentences, by_document: bool, chunk_size: int = None, context: int = 0):
+    """
+    Yield lists of (sentence index, sentence) pairs to annotate together: chunks of `chunk_size`
+    sentences, or whole documents if `by_document`. Documents longer than `chunk_size` sentences are
+    cut up with `_document_chunks`, unless `chunk_size` is None.
+    """
+    if not by_document:
+        pairs = enumerate(sentences)
+        while True:
+            unit = list(itertools.islice(pairs, chunk_size))
+            if len(unit) == 0:
+                return
+            yield unit
+
+    for document in conllu_reader.documents(sentences):
+        if chunk_size is None:
+            yield list(document)
+        else:
+            yield from _document_chunks(document, chunk_size, context)
+
+
+def _read_checkpoint(path: str, settings: dict):
+    if not os.path.exists(path):
+        return 0, 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["settings"] != settings:
+        raise ValueError(f"Checkpoint {path} was made with different settings: {checkpoint['settings']}")
+    return checkpoint["units"], checkpoint["offset"]
+
+
+def _write_checkpoint(path: str, settings: dict, units: int, offset: int):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"settings": settings, "units": units, "offset": offset}, f)
+    os.replace(tmp_path, path)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-annotate a CoNLL-U corpus with the sample services' models.")
+    parser.add_argument("input", help="CoNLL-U file to annotate")
+    parser.add_argument("output", help="NDJSON file to write predictions to")
+    parser.add_argument("--tasks", default=",".join(TASKS), help="comma-separated tasks to run (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1, help="number of worker processes, each with its own models")
+    parser.add_argument("--chunk-size", type=int, default=64,
+                        help="most sentences annotated in each unit of work (default: %(default)s)")
+    parser.add_argument("--context", type=int, default=3,
+                        help="sentences of context around the chunks of a document cut up for sentence splitting "
+                             "(default: %(default)s)")
+    parser.add_argument("--max-pending", type=int, default=None,
+                        help="most units in flight at once (default: twice the number of workers)")
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file (default: OUTPUT.checkpoint)")
+    args = parser.parse_args(argv)
+
+    tasks = [t.strip() for t in args.tasks.split(",") if t.strip()]
+    unknown = [t for t in tasks if t not in TASKS]
+    if len(unknown) > 0 or len(tasks) == 0:
+        parser.error(f"--tasks must be a comma-separated subset of {', '.join(TASKS)}")
+    if args.chunk_size < 1 or args.context < 0:
+        parser.error("--chunk-size must be at least 1 and --context at least 0")
+    max_pending = args.max_pending or 2 * args.workers
+    checkpoint_path = args.checkpoint or args.output + ".checkpoint"
+    by_document = "sentence" in tasks
+    settings = {"input": os.path.abspath(args.input), "tasks": tasks, "chunk_size": args.chunk_size,
+                "context": args.context if by_document else None}
+
+    done, offset = _read_checkpoint(checkpoint_path, settings)
+    if done > 0:
+        sys.stderr.write(f"Resuming after {done} units\n")
+
+    with open(args.input, encoding="utf-8") as f_in, \
+            open(args.output, "r+b" if done > 0 else "wb") as f_out, \
+            multiprocessing.Pool(args.workers, initializer=_init_worker, initargs=(tasks,)) as pool:
+        # Drop anything written after the last checkpoint
+        f_out.truncate(offset)
+        f_out.seek(offset)
+        units = _units(conllu_reader.read_sentences(f_in), by_document, args.chunk_size, args.context)
+        pending = deque()
+
+        def write_next():
+            nonlocal done
+            f_out.write(pending.popleft().get().encode("utf-8"))
+            f_out.flush()
+            done += 1
+            _write_checkpoint(checkpoint_path, settings, done, f_out.tell())
+            if done % 100 == 0:
+                sys.stderr.write(f"Wrote {done} units\n")
+
+        for unit in itertools.islice(units, done, None):
+            pending.append(pool.apply_async(_annotate, (unit,)))
+            if len(pending) >= max_pending:
+                write_next()
+        while len(pending) > 0:
+            write_next()
+
+    sys.stderr.write(f"Done: wrote {done} units to {args.output}\n")
+
+
+if __name__ == "__main__":
+    main()
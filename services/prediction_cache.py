@@ -0,0 +1,171 @@
+"""
+A bounded, least-recently-used cache for model predictions, shared by the NLP services.
+
+Entries are keyed by a short hash of the model input (see `hash_key`) rather than the input itself,
+and the cache is bounded by an estimate of the memory its values take up rather than by a number
+of entries, so that a service's memory use can be sized up front.
+
+Services make their cache with `service_cache`, which is configured with environment variables:
+
+    MIDAS_CACHE_BYTES   the cache's budget in bytes (default 256 MiB)
+    MIDAS_CACHE_DIR     if set, caches are backed by a PredictionStore in this directory, which
+                        survives restarts and is shared by every service process on the host
+    MIDAS_CACHE_STORE_BYTES
+                        the budget of that store's file, shared by every service using it, beyond
+                        which its least recently used rows are deleted (default 1 GiB)
+"""
+import hashlib
+import os
+import sys
+import threading
+from collections import OrderedDict
+from typing import Callable, List
+
+import numpy as np
+
+from prediction_store import PredictionStore
+
+
+def hash_key(*parts: str) -> str:
+    """
+    Return a compact, stable key for a model input made up of one or more strings.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+def sizeof(value) -> int:
+    """
+    Estimate the number of bytes a cached value takes up in memory, including the buffers of numpy
+    arrays and everything held by lists, tuples, and dicts. Objects shared between values, such as
+    interned strings, are counted every time, so the estimate errs on the high side.
+    """
+    if isinstance(value, np.ndarray):
+        # An array's size only includes its buffer if the array owns it
+        return sys.getsizeof(value) + (value.nbytes if value.base is not None else 0)
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(sizeof(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(sizeof(k) + sizeof(v) for k, v in value.items())
+    return sys.getsizeof(value)
+
+
+def forms_key(model_id: str, forms) -> str:
+    """
+    Return a key for a model that only looks at a sentence's token forms, so that edits to any other
+    annotation leave the key unchanged.
+    """
+    return hash_key(model_id, *forms)
+
+
+class LRUCache:
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024, store: PredictionStore = None, model_id: str = None):
+        """
+        If a `store` is given, entries missing from memory are looked up in it under `model_id`,
+        and every entry put in the cache is also written to it.
+        """
+        self.max_bytes = max_bytes
+        self.store = store
+        self.model_id = model_id
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.store_hits = 0
+        # key -> (value, size), least recently used first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        """
+        Return the value for `key` and mark it as recently used, or `default` if it is absent.
+        """
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+        value = self.store.get(self.model_id, key) if self.store is not None else None
+        if value is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self.store_hits += 1
+        self._remember(key, value)
+        return value
+
+    def put(self, key, value):
+        """
+        Store `value` under `key`, evicting least recently used entries until the cache fits in its
+        budget. Values that would not fit in the budget on their own are only kept in the store.
+        """
+        if self.store is not None:
+            self.store.put(self.model_id, key, value)
+        self._remember(key, value)
+
+    def get_or_predict(self, keys: List[str], inputs: List, predict: Callable[[List], List], batch_size: int = None) -> List:
+        """
+        Return the value for each of `keys`, calling `predict` on the `inputs` whose keys aren't in the
+        cache, at most `batch_size` at a time (or all at once), and caching what it returns.
+        """
+        output = [self.get(key) for key in keys]
+        misses = [i for i, value in enumerate(output) if value is None]
+        batch_size = batch_size or max(1, len(misses))
+        for begin in range(0, len(misses), batch_size):
+            batch = misses[begin:begin + batch_size]
+            for i, value in zip(batch, predict([inputs[i] for i in batch])):
+                output[i] = value
+                self.put(keys[i], value)
+        return output
+
+    def _remember(self, key, value):
+        size = sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (value, size)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "store_hits": self.store_hits,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+
+def service_cache(model_id: str) -> LRUCache:
+    """
+    Make the prediction cache for a service's model according to the environment.
+    """
+    max_bytes = int(os.environ.get("MIDAS_CACHE_BYTES", 256 * 1024 * 1024))
+    cache_dir = os.environ.get("MIDAS_CACHE_DIR")
+    store_bytes = int(os.environ.get("MIDAS_CACHE_STORE_BYTES", 1024 * 1024 * 1024))
+    store = PredictionStore(os.path.join(cache_dir, "predictions.sqlite"), store_bytes) if cache_dir else None
+    return LRUCache(max_bytes=max_bytes, store=store, model_id=model_id)
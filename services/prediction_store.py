@@ -0,0 +1,106 @@
+"""
+An on-disk store for model predictions, backed by SQLite, which outlives service restarts and is
+shared by every service process on the same host.
+
+Rows are keyed by a model's identity and a hash of its input, so several services (or several
+versions of the same model) can share a single file without seeing each other's predictions.
+Nothing is read into memory at startup: rows are only read when a key is looked up.
+
+The store is bounded by `max_bytes` of pickled values. Each row records when it was last read or
+written, and every `PRUNE_EVERY` writes a process checks the store's size and, if it is over budget,
+deletes the least recently used rows until it is back under 90% of it.
+"""
+import os
+import pickle
+import sqlite3
+import threading
+import time
+
+# Writes made by a process between checks of the store's size
+PRUNE_EVERY = 256
+# Rows read within this many seconds of their last use don't have their last use updated again
+TOUCH_SECONDS = 60
+
+
+class PredictionStore:
+    def __init__(self, path: str, max_bytes: int = 1024 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.pruned = 0
+        self._writes = 0
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # SQLite connections must not be shared across a fork, so each process opens its own on first use
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+            # Write-ahead logging lets readers in other processes go on while one process writes
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS predictions ("
+                "model TEXT NOT NULL, key TEXT NOT NULL, value BLOB NOT NULL, PRIMARY KEY (model, key)"
+                ") WITHOUT ROWID"
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(predictions)")}
+            if "used" not in columns:
+                # Files written before the store was bounded: count their rows as least recently used
+                conn.execute("ALTER TABLE predictions ADD COLUMN size INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE predictions ADD COLUMN used REAL NOT NULL DEFAULT 0")
+                conn.execute("UPDATE predictions SET size = length(value)")
+            conn.execute("CREATE INDEX IF NOT EXISTS predictions_used ON predictions (used, size)")
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def get(self, model_id: str, key: str):
+        """
+        Return the value stored for `key` under `model_id`, or None if there is none.
+        """
+        now = time.time()
+        with self._lock:
+            conn = self._connection()
+            row = conn.execute(
+                "SELECT value, used FROM predictions WHERE model = ? AND key = ?", (model_id, key)
+            ).fetchone()
+            if row is not None and now - row[1] > TOUCH_SECONDS:
+                conn.execute("UPDATE predictions SET used = ? WHERE model = ? AND key = ?", (now, model_id, key))
+        return pickle.loads(row[0]) if row is not None else None
+
+    def put(self, model_id: str, key: str, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._connection().execute(
+                "INSERT OR REPLACE INTO predictions (model, key, value, size, used) VALUES (?, ?, ?, ?, ?)",
+                (model_id, key, blob, len(blob), time.time())
+            )
+            self._writes += 1
+            if self._writes % PRUNE_EVERY == 0:
+                self._prune()
+
+    def prune(self) -> int:
+        """
+        Delete the least recently used rows if the store is over budget, and return how many were deleted.
+        """
+        with self._lock:
+            return self._prune()
+
+    def _prune(self) -> int:
+        conn = self._connection()
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM predictions").fetchone()[0]
+        if total <= self.max_bytes:
+            return 0
+        # The last use of the most recently used row that doesn't fit in 90% of the budget
+        row = conn.execute(
+            "SELECT used FROM (SELECT used, SUM(size) OVER (ORDER BY used DESC) AS kept FROM predictions) "
+            "WHERE kept > ? LIMIT 1", (int(self.max_bytes * 0.9),)
+        ).fetchone()
+        deleted = conn.execute("DELETE FROM predictions WHERE used <= ?", (row[0],)).rowcount
+        self.pruned += deleted
+        return deleted
+
+    def __len__(self):
+        with self._lock:
+            return self._connection().execute("SELECT COUNT(*) FROM predictions").fetchone()[0]
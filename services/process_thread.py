@@ -0,0 +1,34 @@
+"""
+Background threads that are started lazily, once in each process that uses them.
+
+Threads don't survive a fork: a worker forked from a process that started a background thread has
+a copy of the thread's state, but not the thread. A ProcessThread is instead started by the first
+call to `ensure_started` in each process, which first calls `reset` so that the process can replace
+any state it inherited along with the thread, such as queues or locks that a thread of its parent
+held at the time of the fork.
+"""
+import os
+import threading
+from typing import Callable
+
+
+class ProcessThread:
+    def __init__(self, target: Callable[[], None], reset: Callable[[], None] = None):
+        """
+        `target` is run in a daemon thread, and `reset` just before the thread is started.
+        """
+        self.target = target
+        self.reset = reset
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_started(self):
+        """
+        Start the thread, unless this process already has.
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                if self.reset is not None:
+                    self.reset()
+                threading.Thread(target=self.target, daemon=True).start()
+                self._pid = os.getpid()
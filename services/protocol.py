@@ -0,0 +1,85 @@
+"""
+What a service tells its callers about itself, and how it reads their requests.
+
+`GET /capabilities` describes what a service needs and offers, so that a caller can send it only the
+inputs it reads:
+
+    {"annotation_type": "xpos",
+     "inputs": ["conllu"],
+     "batch": {"route": "/batch", "inputs": ["conllu"]},
+     "micro_batching": true,
+     "formats": ["json", "compact"],
+     "content_encodings": ["gzip"]}
+
+where `inputs` are the keys of the request body that `/` reads, and `batch` is null if the service
+has no route that annotates several sentences in one request.
+
+Request bodies sent with `Content-Encoding: gzip` are decompressed before they reach the service's
+routes. To protect against decompression bombs, bodies that decompress to more than
+`MIDAS_MAX_REQUEST_BYTES` bytes (default 64 MiB) are refused with a 413.
+"""
+import io
+import json
+import os
+import zlib
+from typing import List
+
+from werkzeug.exceptions import BadRequest, RequestEntityTooLarge
+from werkzeug.wsgi import get_input_stream
+
+import encoding
+
+CONTENT_ENCODINGS = ["gzip"]
+
+
+def _gunzip(data: bytes, max_bytes: int) -> bytes:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    body = decompressor.decompress(data, max_bytes + 1)
+    if len(body) > max_bytes:
+        raise RequestEntityTooLarge(f"The request body decompresses to more than {max_bytes} bytes")
+    if not decompressor.eof:
+        raise BadRequest("The request body is not a complete gzip stream")
+    return body
+
+
+class _GunzipRequests:
+    """
+    WSGI middleware that decompresses gzip-encoded request bodies.
+    """
+
+    def __init__(self, wsgi_app, max_bytes: int):
+        self.wsgi_app = wsgi_app
+        self.max_bytes = max_bytes
+
+    def __call__(self, environ, start_response):
+        if environ.get("HTTP_CONTENT_ENCODING", "").strip().lower() == "gzip":
+            try:
+                body = _gunzip(get_input_stream(environ).read(), self.max_bytes)
+            except zlib.error as e:
+                return BadRequest(f"The request body could not be decompressed: {e}")(environ, start_response)
+            except (BadRequest, RequestEntityTooLarge) as e:
+                return e(environ, start_response)
+            environ = dict(environ)
+            del environ["HTTP_CONTENT_ENCODING"]
+            environ["wsgi.input"] = io.BytesIO(body)
+            environ["CONTENT_LENGTH"] = str(len(body))
+        return self.wsgi_app(environ, start_response)
+
+
+def add_capabilities(app, annotation_type: str, inputs: List[str], batch: dict = None, micro_batching: bool = False):
+    """
+    Add `/capabilities` to `app`, and let it accept gzip-encoded request bodies.
+    """
+    capabilities = {
+        "annotation_type": annotation_type,
+        "inputs": list(inputs),
+        "batch": batch,
+        "micro_batching": micro_batching,
+        "formats": [encoding.JSON, encoding.COMPACT],
+        "content_encodings": CONTENT_ENCODINGS,
+    }
+    app.wsgi_app = _GunzipRequests(app.wsgi_app, int(os.environ.get("MIDAS_MAX_REQUEST_BYTES", 64 * 1024 * 1024)))
+
+    @app.route("/capabilities", methods=["GET"])
+    def get_capabilities():
+        return json.dumps(capabilities)
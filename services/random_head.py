@@ -1,37 +1,75 @@
-import json
+"""
+A stand-in for sample_head.py that returns random head probabilities without a model, for load
+testing. See stand_in.py for how to make its output reproducible and to add latency and errors.
+"""
 from flask import Flask, request
-import random
+import numpy as np
+import admission
+import encoding
+import loading
+import metrics
+import protocol
+import serving
+import stand_in
 
 app = Flask(__name__)
+loading.add_probes(app)
+ADMISSION = admission.add_admission_control(app)
+metrics.add_metrics(app, admission=ADMISSION)
+protocol.add_capabilities(app, "head", ["json"])
+PROFILE = stand_in.Profile()
+# Concentration of the Dirichlet distribution that each token's head distribution is drawn from.
+# Values below 1 put most of the mass on a few heads, as a parser does.
+ALPHA = 0.1
+# Normalized gamma draws are Dirichlet draws
+GAMMAS = stand_in.draw_pool(lambda rng, size: rng.standard_gamma(ALPHA, size))
 
 
-def get_head_probas(sentence):
+@metrics.timed("inference")
+def _head_matrix(sentence: dict):
     """
-    Given an English sentence in conllu format, return POS tag probabilities for each token.
+    Return a random (n_tokens, n_tokens + 1) head probability matrix for a sentence, where column 0 is
+    the root and no token is its own head, along with the head ID of each column.
     """
     # "token-type" can be "super", "empty", or "token"--we want everything that's not a supertoken
     tokens = [t for t in sentence["sentence/tokens"] if t["token/token-type"] != "super"]
-    token_forms = [t["token/form"]["form/value"] for t in tokens]
+    head_ids = ["root"] + [t["token/id"] for t in tokens]
+    n = len(tokens)
+    matrix = GAMMAS.take(n * (n + 1), *(t["token/form"]["form/value"] for t in tokens)).reshape(n, n + 1)
+    matrix[np.arange(n), np.arange(1, n + 1)] = 0.0
+    sums = matrix.sum(axis=1, keepdims=True)
+    if not sums.all():
+        # With a small ALPHA, a row could underflow to all zeros, in which case its token gets the root
+        matrix[sums[:, 0] == 0, 0] = 1.0
+        sums = matrix.sum(axis=1, keepdims=True)
+    return matrix / sums, head_ids
 
-    labels = []
-    for token in tokens:
-        remainder = 1
-        probs = []
-        potential_heads = ["root"] + [t["token/id"] for t in tokens if t["token/id"] != token["token/id"]]
-        for _ in potential_heads:
-            prob = random.random() * remainder
-            probs.append(prob)
-            remainder = remainder - sum(probs)
-        probs = [x / sum(probs) for x in probs]
-        labels.append({head: prob for head, prob in zip(potential_heads, probs)})
 
-    return labels
+def _to_dicts(matrix, head_ids):
+    # Leave each token out of its own distribution, where its probability is always 0
+    rows = encoding.to_dicts(matrix, head_ids)
+    for row, head_id in zip(rows, head_ids[1:]):
+        del row[head_id]
+    return rows
+
+
+def get_head_probas(sentence: dict):
+    """
+    Given an English sentence in a dictionary representing midas-loop json format,
+    return random head probabilities for each token.
+    """
+    return _to_dicts(*_head_matrix(sentence))
 
 
 @app.route("/", methods=["POST"])
 def get():
     data = request.json
-    return json.dumps({"probabilities": get_head_probas(data["json"])})
+    fmt = encoding.request_format(data)
+    matrix, head_ids = _head_matrix(data["json"])
+    PROFILE.apply(len(matrix))
+    if fmt == encoding.COMPACT:
+        return metrics.dumps(encoding.encode(matrix, head_ids, fmt))
+    return metrics.dumps({"probabilities": _to_dicts(matrix, head_ids)})
 
 
 SAMPLE_SENTENCE = """
@@ -46,4 +84,4 @@ def debug():
 
 if __name__ == "__main__":
     # debug()
-    app.run(host="localhost", port=5557)
+    serving.serve(app, port=5557)
@@ -1,48 +1,63 @@
-import random
-from collections.abc import Iterable
-import json
+"""
+A stand-in for sample_sentence.py that returns random sentence boundary probabilities without a
+model, for load testing. See stand_in.py for how to make its output reproducible and to add latency
+and errors.
+"""
+import re
 from flask import Flask, request
-from typing import List, Tuple
-import conllu
+from typing import List
 import numpy as np
-import spacy
-
-from time import sleep
+import conllu_reader
+import admission
+import encoding
+import loading
+import metrics
+import protocol
+import serving
+import stand_in
 
 app = Flask(__name__)
+loading.add_probes(app)
+ADMISSION = admission.add_admission_control(app)
+metrics.add_metrics(app, admission=ADMISSION)
+protocol.add_capabilities(app, "sentence", ["conllu"])
+PROFILE = stand_in.Profile()
 
+# Lines of plain tokens, whose IDs are integers, in tab- or space-separated CoNLL-U
+TOKEN_LINE = re.compile(r"^\d+(?:\t| {2,})", re.MULTILINE)
+# Probabilities that a token begins a sentence, one of which is drawn for each token
+B_PROBAS = np.array(16 * [0.01] + [0.12, 0.98, 0.9, 0.88])
+B_DRAWS = stand_in.draw_pool(lambda rng, size: rng.choice(B_PROBAS, size))
 
-def is_supertoken(t):
-    return isinstance(t["id"], Iterable) and t["id"][1] == "-"
-
-
-def is_ellipsis(t):
-    return isinstance(t["id"], Iterable) and t["id"][1] == "."
 
-
-def is_plain_token(t):
-    return not isinstance(t["id"], Iterable)
+@metrics.timed("inference")
+def _split_matrix(conllu_sentence: str):
+    """
+    Return a random (n_tokens, 2) matrix of B and O probabilities for a sentence's plain tokens.
+    Tokens are only counted, so the sentence isn't parsed.
+    """
+    n = len(TOKEN_LINE.findall(conllu_sentence))
+    matrix = np.empty((n, 2))
+    matrix[:, 0] = B_DRAWS.take(n, conllu_sentence)
+    matrix[:, 1] = 1.0 - matrix[:, 0]
+    return matrix
 
 
-def random_splits(conllu_sentence: str):
+def random_splits(conllu_sentence: str) -> List[dict]:
     """
-    Given an English sentence in conllu format, return POS tag probabilities for each token.
+    Given an English sentence in conllu format, return random probabilities that each token
+    begins a new sentence (B) or not (O).
     """
-    sentence = conllu.parse(conllu_sentence)[0]
-    sentence = [t for t in sentence if is_plain_token(t)]
-    labels = []
-    for i, t in enumerate(sentence):
-        v = random.choice((16*[0.01]) + [0.12, 0.98, 0.9, 0.88])
-        softmax = {"B": v, "O": 1. - v}
-        labels.append(softmax)
-
-    return labels
+    return encoding.to_dicts(_split_matrix(conllu_sentence), ["B", "O"])
 
 
 @app.route("/", methods=["POST"])
 def get():
     data = request.json
-    return json.dumps({"probabilities": random_splits(data["conllu"])})
+    fmt = encoding.request_format(data)
+    matrix = _split_matrix(data["conllu"])
+    PROFILE.apply(len(matrix))
+    return metrics.dumps(encoding.encode(matrix, ["B", "O"], fmt))
 
 
 SAMPLE = """# sent_id = AMALGUM_reddit_beatty-47
@@ -61,14 +76,14 @@ SAMPLE = """# sent_id = AMALGUM_reddit_beatty-47
 
 
 def debug():
-    tokens = conllu.parse(SAMPLE)[0]
+    forms = next(conllu_reader.read_sentences(SAMPLE)).forms_of(conllu_reader.TOKEN)
 
-    for token, probas in zip([t for t in tokens if is_plain_token(t)], tag_conllu(SAMPLE)):
-        print(token["form"])
+    for form, probas in zip(forms, random_splits(SAMPLE)):
+        print(form)
         print({x:y for x,y in probas.items() if y > 0.0001})
         print()
 
 
 if __name__ == "__main__":
     # debug()
-    app.run(host="localhost", port=5556)
+    serving.serve(app, port=5556)
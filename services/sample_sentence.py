@@ -10,146 +10,300 @@ Then download our model:
 
 and place it in the working directory you intend to run this script from.
 """
-from collections.abc import Iterable
-import json, sys
+import json, os, sys
 from flask import Flask, request
 from typing import List, Tuple
 import numpy as np
-from collections import defaultdict
-import conllu
+import conllu_reader
 import flair
 from flair.models import SequenceTagger
 from flair.data import Sentence
+import admission
+import cpu_inference
+import encoding
+import loading
+import metrics
+import protocol
+from batching import MicroBatcher
+import shingles
+from prediction_cache import hash_key, service_cache
+import serving
 
 from time import sleep
 
 app = Flask(__name__)
 
-# Load splitter model
-model = SequenceTagger.load("flair-splitter-sent.pt")
+# Splitter model, set by _load, which LOADER runs in the background
+model = None
+MODEL_ID = "flair/flair-splitter-sent.pt"
+LABELS = ["B", "O"]
+# Number of shingles given to flair at once
+MINI_BATCH_SIZE = int(os.environ.get("MIDAS_FLAIR_MINI_BATCH", 32))
 
-cache = {}
+# Holds (n_tokens, 2) float32 matrices of B and O probabilities keyed by a hash of the document's tokens,
+# as well as the last (tokens, matrix, whether the matrix is exact) of each document, which are used to re-predict only what changed after an edit
+cache = service_cache(MODEL_ID)
 
-def is_supertoken(t):
-    return isinstance(t["id"], Iterable) and t["id"][1] == "-"
 
+def _load():
+    global model, MODEL_ID
+    model = SequenceTagger.load("flair-splitter-sent.pt")
+    if cpu_inference.ENABLED:
+        cpu_inference.configure_threads()
+        sample_toks, _, _ = _read_document(SAMPLE_DOC)
+        if cpu_inference.quantize(sys.modules[__name__], "model", _split_matrices, cpu_inference.check_sentences([sample_toks])):
+            MODEL_ID += cpu_inference.INT8_SUFFIX
+            cache.model_id = MODEL_ID
 
-def is_ellipsis(t):
-    return isinstance(t["id"], Iterable) and t["id"][1] == "."
 
+@metrics.timed("read")
+def _read_document(full_conllu: str):
+    """
+    Read a document and return its token forms, the (begin, end, sent_id) token offsets
+    of each of its sentences, and its newdoc id (or None if it has none).
+    """
+    toks = []
+    bounds = []
+    doc_id = None
+    for i, sent in enumerate(conllu_reader.read_sentences(full_conllu)):
+        if i == 0:
+            doc_id = sent.metadata.get("newdoc id")
+        begin = len(toks)
+        # Supertokens and ellipsis tokens are filtered out since they are not valid targets for annotation.
+        toks.extend(sent.forms_of(conllu_reader.TOKEN))
+        bounds.append((begin, len(toks), sent.metadata.get("sent_id")))
+    metrics.inc("midas_tokens_total", len(toks))
+    return toks, bounds, doc_id
+
+
+def _reuse_predictions(old_toks: List[str], old_matrix: np.ndarray, toks: List[str], plan: shingles.ShinglePlan):
+    """
+    Diff a document's tokens against the tokens of its last prediction. Return a probability matrix
+    where tokens whose most central shingle did not see the edit (before or after it) reuse their old
+    prediction, along with the indexes of all other tokens, whose rows are left unset.
 
-def is_plain_token(t):
-    return not isinstance(t["id"], Iterable)
+    If the edit changed the number of tokens, shingles after it are aligned differently than before,
+    so reused predictions there may differ slightly from what a fresh prediction would give.
+    """
+    n_old, n = len(old_toks), len(toks)
+    limit = min(n_old, n)
+    prefix = 0
+    while prefix < limit and old_toks[prefix] == toks[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old_toks[n_old - 1 - suffix] == toks[n - 1 - suffix]:
+        suffix += 1
+
+    old_plan = shingles.plan(n_old, plan.span_size, plan.stride_size)
+    # Whether each token's most central shingle saw the edit, now and before it
+    new_dirty = plan.dirty(prefix, n - suffix)[plan.shingle]
+    old_dirty = old_plan.dirty(prefix, n_old - suffix)[old_plan.shingle]
+
+    # Each token's index before the edit, or -1 for tokens inside the edit
+    old_index = np.full(n, -1)
+    old_index[:prefix] = np.arange(prefix)
+    old_index[n - suffix:] = np.arange(n_old - suffix, n_old)
+    reusable = (old_index >= 0) & ~new_dirty
+    reusable[reusable] = ~old_dirty[old_index[reusable]]
+
+    matrix = np.empty((n, 2), dtype=np.float32)
+    matrix[reusable] = old_matrix[old_index[reusable]]
+    return matrix, np.flatnonzero(~reusable)
+
+
+def _token_probas(token):
+    """
+    Return the B and O probabilities of a token that the model has labeled.
+    """
+    if str(flair.__version__).startswith("0.4"):
+        pred_tag = token.tags["ner"].value.replace("-SENT","")
+        pred_proba = token.tags["ner"].score
+    else:
+        pred_tag = token.labels[0].value.replace("-SENT","")
+        pred_proba = token.labels[0].score
+    return (pred_proba, 1 - pred_proba) if pred_tag == "B" else (1 - pred_proba, pred_proba)
 
 
-def ssplit(full_conllu: str, sent_conllu: str, span_size: int=20, stride_size: int=10, sentence_index: int=-1):
+def _predict_shingles(span_lists: List[List[Sentence]]):
     """
-    Given a document in a dictionary representing midas-loop json format,
-    return probabilities that each token begins a new sentence (B) or not (O).
+    Label the shingles of several requests in place with a single call to the model.
     """
-    # Supertokens are filtered out of the sentence since they are not valid targets for annotation.
-    toks = []
-    ids = []
-    parsed = conllu.parse(full_conllu)
-    target_begin = -1
-    target_end = -1
-    toknum = 0
+    with metrics.timer("inference"), cpu_inference.inference():
+        model.predict([span for spans in span_lists for span in spans], mini_batch_size=MINI_BATCH_SIZE)
+    return span_lists
 
-    global cache
-    if len(cache) > 1000:  # Prevent possible memory leak if service is run on thousands of documents
-        for key in cache:
-            del cache[key]
-            break
-    #sys.stderr.write("target:\n")
-    #sys.stderr.write(sent_conllu + "\n")
+
+# Concurrent requests share calls to the model
+BATCHER = MicroBatcher(_predict_shingles)
+
+
+def _shingle_sentences(toks: List[str], plan: shingles.ShinglePlan, snums) -> List[Sentence]:
+    """
+    Return a flair Sentence holding the tokens of each of the shingles numbered `snums`.
+    """
+    # flair 0.6.1's Sentence only takes a string, so tokens are joined and split back apart
+    return [Sentence(" ".join(span), use_tokenizer=lambda x: x.split()) for span in plan.shingle_tokens(toks, snums)]
+
+
+def _split_matrices(documents: List[List[str]]):
+    """
+    Return an (n_tokens, 2) matrix of B and O probabilities for each document's tokens, predicting
+    every shingle of each one without going through the cache or the batcher.
+    """
+    matrices = []
+    for toks in documents:
+        plan = shingles.plan(len(toks), 20, 10)
+        spans = _shingle_sentences(toks, plan, np.arange(len(plan.starts)))
+        _predict_shingles([spans])
+        matrices.append(np.array([_token_probas(spans[snum].tokens[position])
+                                  for snum, position in zip(plan.shingle.tolist(), plan.position.tolist())],
+                                 dtype=np.float32).reshape(-1, 2))
+    return matrices
+
+
+def _sample_shingles():
+    toks, _, _ = _read_document(SAMPLE_DOC)
+    plan = shingles.plan(len(toks), 20, 10)
+    return _shingle_sentences(toks, plan, np.arange(len(plan.starts)))
+
+
+LOADER = loading.ModelLoader(_load, loading.batched_warm_up(BATCHER, _sample_shingles))
+loading.add_probes(app, LOADER)
+ADMISSION = admission.add_admission_control(app)
+metrics.add_metrics(app, cache=cache, admission=ADMISSION,
+                    model_bytes=lambda: metrics.torch_bytes(model) if model is not None else None)
+# `conllu` is only read if `sentence_index` is missing or negative
+protocol.add_capabilities(app, "sentence", ["full_conllu", "sentence_index"],
+                          batch={"route": "/document", "inputs": ["full_conllu"]}, micro_batching=True)
+
+
+def _predict(toks: List[str], span_size: int, stride_size: int, doc_id: str = None) -> np.ndarray:
+    """
+    Return an (n_tokens, 2) matrix of B and O probabilities for the document, using cached predictions if
+    this exact token sequence has been seen before. If only the last prediction for the same
+    document is available, only the shingles affected by the difference are predicted again.
+
+    Predictions are only cached under the document's tokens if they are what a fresh prediction
+    would give, i.e. if they reuse nothing from before an edit that changed the number of tokens.
+    """
+    # Keys say what kind of value they hold, so that values of another shape in a persistent store are never read
+    tok_key = hash_key("tokens-matrix", str(span_size), str(stride_size), " ".join(toks))
+    matrix = cache.get(tok_key)
+    if matrix is not None:
+        return matrix
+
+    plan = shingles.plan(len(toks), span_size, stride_size)
+    doc_key = hash_key("document-matrix", str(span_size), str(stride_size), doc_id) if doc_id is not None else None
+    previous = cache.get(doc_key) if doc_key is not None else None
+    if previous is not None:
+        old_toks, old_matrix, old_exact = previous
+        matrix, stale = _reuse_predictions(old_toks, old_matrix, toks, plan)
+        exact = (old_exact and len(old_toks) == len(toks)) or len(stale) == len(toks)
+    else:
+        matrix, stale = np.empty((len(toks), 2), dtype=np.float32), np.arange(len(toks))
+        exact = True
+
+    # Get a fresh prediction for every shingle that a stale token is most central in
+    snums = np.unique(plan.shingle[stale])
+    spans = _shingle_sentences(toks, plan, snums)  # Holds flair Sentence objects for labeling
+    if len(spans) > 0:
+        BATCHER.submit(spans, deadline=admission.deadline())
+    predicted = dict(zip(snums.tolist(), spans))
+
+    for idx, (snum, position) in enumerate(zip(plan.shingle.tolist(), plan.position.tolist())):
+        if snum in predicted:
+            matrix[idx] = _token_probas(predicted[snum].tokens[position])
+
+    if exact:
+        cache.put(tok_key, matrix)
+    if doc_key is not None:
+        cache.put(doc_key, (toks, matrix, exact))
+    return matrix
+
+
+def _ssplit_matrix(full_conllu: str, sent_conllu: str, span_size: int=20, stride_size: int=10, sentence_index: int=-1):
+    """
+    Like `ssplit`, but return an (n_tokens, 2) matrix of B and O probabilities.
+    """
+    LOADER.wait()
+    toks, bounds, doc_id = _read_document(full_conllu)
+    target_begin = -1
+    target_end = len(toks)
 
     # TODO: remove hack for detecting sentence token offset position in doc conllu
-    for i, sent in enumerate(parsed):
-        if target_begin != -1 and target_end == -1:  # Beginning already set and new sent has started
-            target_end = toknum
+    for i, (begin, end, sent_id) in enumerate(bounds):
         if sentence_index > -1:  # System specified ordinal sentence index
-            if i == sentence_index:
-                target_begin = toknum
+            found = i == sentence_index
         else:
-            if sent.metadata["sent_id"] + "\n" in sent_conllu:  # This is the target sent
-                #sys.stderr.write("Found ID "+ sent.metadata["sent_id"] + "\n")
-                target_begin = toknum
-        for tok in sent:
-            if not is_supertoken(tok) and not is_ellipsis(tok):
-                toknum += 1
-                toks.append(tok["form"])
-                ids.append(tok["id"])
-
-    if target_end == -1:
-        target_end = toknum
-
-    # Get a fresh prediction
-    final_mapping = {}  # Map each contextualized token to its (sequence_number, position)
-    spans = []  # Holds flair Sentence objects for labeling
-
-    tok_string = " ".join(toks)
-    if tok_string in cache:
-        preds = cache[tok_string]
-    else:
-        # Hack tokens up into overlapping shingles
-        wraparound = toks[-stride_size :] + toks + toks[: span_size]
-        idx = 0
-        mapping = defaultdict(set)
-        snum = 0
-        while idx < len(toks):
-            if idx + span_size < len(wraparound):
-                span = wraparound[idx : idx + span_size]
-            else:
-                span = wraparound[idx:]
-            sent = Sentence(" ".join(span), use_tokenizer=lambda x: x.split())
-            spans.append(sent)
-            for i in range(idx - stride_size, idx + span_size - stride_size):
-                # start, end, snum
-                if i >= 0 and i < len(toks):
-                    mapping[i].add((idx - stride_size, idx + span_size - stride_size, snum))
-            idx += stride_size
-            snum += 1
-
-        for idx in mapping:
-            best = span_size
-            for m in mapping[idx]:
-                start, end, snum = m
-                dist_to_end = end - idx
-                dist_to_start = idx - start
-                delta = abs(dist_to_end - dist_to_start)
-                if delta < best:
-                    best = delta
-                    final_mapping[idx] = (snum, idx - start)  # Get sentence number and position in sentence
-
-        # Predict
-        model.predict(spans)
-
-        preds = []
-        for idx in final_mapping:
-            snum, position = final_mapping[idx]
-            if str(flair.__version__).startswith("0.4"):
-                pred_tag = spans[snum].tokens[position].tags["ner"].value.replace("-SENT","")
-                pred_proba = spans[snum].tokens[position].tags["ner"].score
-            else:
-                pred_tag = spans[snum].tokens[position].labels[0].value.replace("-SENT","")
-                pred_proba = spans[snum].tokens[position].labels[0].score
-            other_tag = "B" if pred_tag == "O" else "O"
-            other_proba = 1-pred_proba
-            tid = ids[idx]
-
-            #preds.append({tid:{pred_tag:pred_proba,other_tag:other_proba}})
-            preds.append({pred_tag:pred_proba,other_tag:other_proba})
-        cache[tok_string] = preds
-
-    #sys.stderr.write(str(target_begin) + "\n")
-    #sys.stderr.write(str(target_end)+ "\n")
-    return preds[target_begin:target_end]
+            found = sent_id is not None and sent_id + "\n" in sent_conllu  # This is the target sent
+        if found:
+            target_begin, target_end = begin, end
+            break
+
+    matrix = _predict(toks, span_size, stride_size, doc_id=doc_id)
+    return matrix[target_begin:target_end]
+
+
+def _ssplit_document_matrices(full_conllu: str, span_size: int=20, stride_size: int=10):
+    """
+    Like `ssplit_document`, but with an (n_tokens, 2) matrix of B and O probabilities for each sentence.
+    """
+    LOADER.wait()
+    toks, bounds, doc_id = _read_document(full_conllu)
+    matrix = _predict(toks, span_size, stride_size, doc_id=doc_id)
+    return [
+        {"sentence_index": i, "sent_id": sent_id, "probabilities": matrix[begin:end]}
+        for i, (begin, end, sent_id) in enumerate(bounds)
+    ]
+
+
+def ssplit(full_conllu: str, sent_conllu: str, span_size: int=20, stride_size: int=10, sentence_index: int=-1):
+    """
+    Given a document in a dictionary representing midas-loop json format,
+    return probabilities that each token begins a new sentence (B) or not (O).
+    """
+    return encoding.to_dicts(_ssplit_matrix(full_conllu, sent_conllu, span_size, stride_size, sentence_index), LABELS)
+
+
+def ssplit_document(full_conllu: str, span_size: int=20, stride_size: int=10):
+    """
+    Like `ssplit`, but return the probabilities for every sentence in the document at once,
+    as a list of dicts holding each sentence's index, sent_id, and probabilities.
+    """
+    sentences = _ssplit_document_matrices(full_conllu, span_size, stride_size)
+    for sentence in sentences:
+        sentence["probabilities"] = encoding.to_dicts(sentence["probabilities"], LABELS)
+    return sentences
 
 
 @app.route("/", methods=["POST"])
 def get():
     data = request.json
-    return json.dumps({"probabilities": ssplit(data["full_conllu"],data["conllu"],sentence_index=data["sentence_index"])})
+    fmt = encoding.request_format(data)
+    matrix = _ssplit_matrix(data["full_conllu"], data.get("conllu", ""), sentence_index=data.get("sentence_index", -1))
+    return metrics.dumps(encoding.encode(matrix, LABELS, fmt))
+
+
+@app.route("/document", methods=["POST"])
+def get_document():
+    """
+    Like `/`, but only `full_conllu` is required, and the response's `sentences` key holds
+    the probabilities for every sentence in the document.
+    """
+    data = request.json
+    fmt = encoding.request_format(data)
+    sentences = _ssplit_document_matrices(data["full_conllu"])
+    encode = encoding.pack if fmt == encoding.COMPACT else lambda m: encoding.to_dicts(m, LABELS)
+    for sentence in sentences:
+        sentence["probabilities"] = encode(sentence["probabilities"])
+    if fmt == encoding.COMPACT:
+        return metrics.dumps({"format": fmt, "dtype": encoding.DTYPE, "labels": LABELS, "sentences": sentences})
+    return metrics.dumps({"sentences": sentences})
+
+
+@app.route("/cache", methods=["GET"])
+def get_cache_stats():
+    return json.dumps(cache.stats())
 
 
 null = None
@@ -195,7 +349,7 @@ def debug():
 
 
 if __name__ == "__main__":
-    app.run(host="localhost", port=5556)
+    serving.serve(app, port=5556, loader=LOADER)
     #debug()
 
 
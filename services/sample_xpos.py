@@ -1,10 +1,17 @@
-from collections.abc import Iterable
 import json
 from flask import Flask, request
 from typing import List, Tuple
-import conllu
 import numpy as np
 import spacy
+import conllu_reader
+import admission
+import encoding
+import loading
+import metrics
+import protocol
+from batching import MicroBatcher
+from prediction_cache import forms_key, service_cache
+import serving
 
 from time import sleep
 
@@ -16,84 +23,152 @@ def softmax(x, axis=None):
     return y / y.sum(axis=axis, keepdims=True)
 
 
-class WhitespaceTokenizer:
-    def __init__(self, vocab):
-        self.vocab = vocab
+# Set by _load, which LOADER runs in the background
+MODEL = None
+TAGGER = None
+# Components that must run on a doc before the tagger's model can predict on it
+UPSTREAM = None
+NORMALIZE_WITH_SOFTMAX = False
+# Number of sentences given to the tagger at once by the /batch route
+BATCH_SIZE = 64
+# The tagger only sees token forms, so its outputs are cached by a hash of the forms
+MODEL_ID = "spacy/en_core_web_sm-" + spacy.util.get_package_version("en_core_web_sm")
+cache = service_cache(MODEL_ID)
 
-    def __call__(self, text):
-        words = text.split(" ")
-        spaces = [True] * len(words)
-        # Avoid zero-length tokens
-        for i, word in enumerate(words):
-            if word == "":
-                words[i] = " "
-                spaces[i] = False
-        # Remove the final trailing space
-        if words[-1] == " ":
-            words = words[0:-1]
-            spaces = spaces[0:-1]
-        else:
-           spaces[-1] = False
 
-        return spacy.tokens.Doc(self.vocab, words=words, spaces=spaces)
+def _load():
+    global MODEL, TAGGER, UPSTREAM
+    # Only the tagger and the tok2vec it listens to are needed, so skip loading everything else
+    MODEL = spacy.load("en_core_web_sm", exclude=["parser", "ner", "lemmatizer", "attribute_ruler", "senter"])
+    TAGGER = MODEL.get_pipe("tagger")
+    UPSTREAM = [proc for name, proc in MODEL.pipeline if name != "tagger"]
 
 
-MODEL = spacy.load("en_core_web_sm")
-TAGGER = MODEL.get_pipe("tagger")
-MODEL.tokenizer = WhitespaceTokenizer(MODEL.vocab)
-NORMALIZE_WITH_SOFTMAX = False
+@metrics.timed("read")
+def _forms(conllu_sentence: str) -> List[str]:
+    # Read the string and take its first sentence (the string only has one sentence)
+    sentence = next(conllu_reader.read_sentences(conllu_sentence))
+    # Supertokens are filtered out of the sentence since they are not valid targets for annotation.
+    forms = sentence.forms_of(conllu_reader.TOKEN, conllu_reader.EMPTY)
+    metrics.inc("midas_tokens_total", len(forms))
+    return forms
+
+
+@metrics.timed("normalize")
+def _normalize(token_probas):
+    """
+    Normalize the tagger's scores for one sentence into an (n_tokens, n_labels) probability matrix
+    whose columns follow TAGGER.labels.
+    """
+    global NORMALIZE_WITH_SOFTMAX
+    token_probas = np.float64(token_probas)
+    if not NORMALIZE_WITH_SOFTMAX and (token_probas < 0).any():
+        NORMALIZE_WITH_SOFTMAX = True
+        print("Negative probability detected! We're probably getting logits instead. Normalizing with softmax.")
+    if NORMALIZE_WITH_SOFTMAX:
+        return softmax(token_probas, axis=1)
+    return token_probas / token_probas.sum(axis=1, keepdims=True)
+
+
+def _tag_forms(forms_list: List[List[str]]):
+    """
+    Tag a batch of sentences, given as lists of token forms, with a single call to the tagger.
+    """
+    with metrics.timer("inference"):
+        # Make spacy docs straight from the token forms, skipping the tokenizer
+        docs = [spacy.tokens.Doc(MODEL.vocab, words=forms) for forms in forms_list]
+        for proc in UPSTREAM:
+            docs = list(proc.pipe(docs, batch_size=len(docs)))
+        # Get probabilities from the tagger, whose own component is never run
+        scores = TAGGER.model.predict(docs)
+    return [_normalize(token_probas) for token_probas in scores]
+
+
+# Concurrent requests to `/` share calls to the tagger
+BATCHER = MicroBatcher(_tag_forms)
+
+
+LOADER = loading.ModelLoader(_load, loading.batched_warm_up(BATCHER, lambda: _forms(SAMPLE)))
+loading.add_probes(app, LOADER)
+ADMISSION = admission.add_admission_control(app)
 
-def is_supertoken(t):
-    return isinstance(t["id"], Iterable) and t["id"][1] == "-"
 
+def _model_bytes():
+    if MODEL is None:
+        return None
+    # Parameters of the thinc models of the tagger and of the tok2vec it listens to
+    nodes = [node for _, proc in MODEL.pipeline for node in proc.model.walk()]
+    return sum(node.get_param(name).nbytes for node in nodes for name in node.param_names if node.has_param(name))
 
-def is_ellipsis(t):
-    return isinstance(t["id"], Iterable) and t["id"][1] == "."
 
+metrics.add_metrics(app, cache=cache, admission=ADMISSION, model_bytes=_model_bytes)
+protocol.add_capabilities(app, "xpos", ["conllu"], batch={"route": "/batch", "inputs": ["conllu"]}, micro_batching=True)
 
-def is_plain_token(t):
-    return not isinstance(t["id"], Iterable)
+
+def _tag_matrix(conllu_sentence: str):
+    forms = _forms(conllu_sentence)
+    key = forms_key(MODEL_ID, forms)
+    matrix = cache.get(key)
+    if matrix is None:
+        matrix = BATCHER.submit(forms, deadline=admission.deadline())
+        cache.put(key, matrix)
+    return matrix
+
+
+def _tag_matrices(conllu_sentences: List[str], batch_size: int):
+    def tag_batch(batch):
+        admission.check_deadline()
+        metrics.observe("midas_batch_size", len(batch))
+        return _tag_forms(batch)
+
+    forms = [_forms(s) for s in conllu_sentences]
+    return cache.get_or_predict([forms_key(MODEL_ID, f) for f in forms], forms, tag_batch, batch_size)
 
 
 def tag_conllu(conllu_sentence: str):
     """
     Given an English sentence in conllu format, return POS tag probabilities for each token.
     """
-    global NORMALIZE_WITH_SOFTMAX
-    # Parse the string and take its first sentence (the string only has one sentence)
-    sentence = conllu.parse(conllu_sentence)[0]
-    # Supertokens are filtered out of the sentence since they are not valid targets for annotation.
-    sentence = [t for t in sentence if not is_supertoken(t)]
-    # Make a spacy doc from the token forms
-    #doc = spacy.tokens.Doc(MODEL.vocab, words=[t["form"] for t in sentence], spaces=spaces)
-    doc = MODEL(" ".join([t["form"] for t in sentence]))
-
-    # Get probabilities from the tagger
-    # float32 isn't JSON serializable by Python's `json` module--make it 64
-    token_probas = np.float64(TAGGER.model.predict([doc])[0])
-    if not NORMALIZE_WITH_SOFTMAX and (token_probas < 0).any():
-        NORMALIZE_WITH_SOFTMAX = True
-        print("Negative probability detected! We're probably getting logits instead. Normalizing with softmax.")
-    if NORMALIZE_WITH_SOFTMAX:
-        normalized_token_probas = softmax(token_probas, axis=1)
-    else:
-        normalized_token_probas = [a / a.sum() for a in token_probas]
+    LOADER.wait()
+    return encoding.to_dicts(_tag_matrix(conllu_sentence), TAGGER.labels)
 
-    # Merge probabilities with the class labels
-    labels = TAGGER.labels
 
-    # Make label-proba pairs and sort them
-    with_labels = [
-        {label: proba for label, proba in zip(labels, probas)}
-        for probas in normalized_token_probas
-    ]
-    return with_labels
+def tag_conllu_batch(conllu_sentences: List[str], batch_size: int = BATCH_SIZE):
+    """
+    Given a list of English sentences in conllu format, return a list of POS tag probabilities
+    for each token, one list per sentence. Sentences are given to the tagger `batch_size` at a time.
+    """
+    LOADER.wait()
+    return [encoding.to_dicts(m, TAGGER.labels) for m in _tag_matrices(conllu_sentences, batch_size)]
 
 
 @app.route("/", methods=["POST"])
 def get():
     data = request.json
-    return json.dumps({"probabilities": tag_conllu(data["conllu"])})
+    fmt = encoding.request_format(data)
+    return metrics.dumps(encoding.encode(_tag_matrix(data["conllu"]), TAGGER.labels, fmt))
+
+
+@app.route("/batch", methods=["POST"])
+def get_batch():
+    """
+    Like `/`, but `conllu` is a list of sentences, and `probabilities` is a list with one
+    entry per sentence. An optional `batch_size` overrides BATCH_SIZE for this request.
+    """
+    data = request.json
+    fmt = encoding.request_format(data)
+    try:
+        batch_size = int(data.get("batch_size", BATCH_SIZE))
+    except (TypeError, ValueError):
+        batch_size = 0
+    if batch_size < 1:
+        return json.dumps({"error": "batch_size must be a positive integer"}), 400
+    return metrics.dumps(encoding.encode_many(_tag_matrices(data["conllu"], batch_size), TAGGER.labels, fmt))
+
+
+@app.route("/cache", methods=["GET"])
+def get_cache_stats():
+    return json.dumps(cache.stats())
 
 
 SAMPLE = """# sent_id = AMALGUM_reddit_beatty-47
@@ -112,14 +187,14 @@ SAMPLE = """# sent_id = AMALGUM_reddit_beatty-47
 
 
 def debug():
-    tokens = conllu.parse(SAMPLE)[0]
+    forms = _forms(SAMPLE)
 
-    for token, probas in zip(tokens, tag_conllu(SAMPLE)):
-        print(token["form"])
+    for form, probas in zip(forms, tag_conllu(SAMPLE)):
+        print(form)
         print({x:y for x,y in probas.items() if y > 0.0001})
         print()
 
 
 if __name__ == "__main__":
-    app.run(host="localhost", port=5555)
+    serving.serve(app, port=5555, loader=LOADER)
     #debug()
@@ -0,0 +1,93 @@
+"""
+Runs a service's Flask app, either with Flask's development server or with gunicorn in production.
+
+Services load their models in the background (see `loading.py`) and pass their loader to `serve`.
+The development server starts answering right away, and answers 503 until the model is ready. In
+production, `serve` runs gunicorn with `preload_app`, so that the gunicorn master loads the model
+(but doesn't warm it up) before it forks its workers, while connections made in the meantime wait in
+the socket's backlog. Forked workers share the master's memory pages copy-on-write, so the model
+weights are only held in memory once however many workers there are. Each worker then warms the
+model up on its own, and gunicorn replaces workers that die.
+
+Serving is configured with environment variables:
+
+    MIDAS_HOST              interface to listen on (default localhost)
+    MIDAS_WORKERS           number of worker processes. With 1 (the default), the development server
+                            is used, and with more, gunicorn, which then has to be installed.
+    MIDAS_THREADS           intra-op threads each worker gives to torch and BLAS (default: the number
+                            of cores divided by the number of workers), so that workers don't
+                            oversubscribe the cores
+    MIDAS_REQUEST_THREADS   threads each gunicorn worker handles requests with (default 128). It
+                            should be above `MIDAS_MAX_IN_FLIGHT` (see `admission.py`), so that
+                            requests past the limit are turned away rather than queued.
+"""
+import gc
+import os
+
+
+def limit_threads(n: int):
+    """
+    Limit the number of threads torch and BLAS libraries use for a single operation in this process.
+    Both libraries are optional: whichever isn't installed is left alone.
+    """
+    try:
+        import torch
+        torch.set_num_threads(n)
+    except ImportError:
+        pass
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(n)
+    except ImportError:
+        pass
+
+
+def _gunicorn_app(app, bind: str, workers: int, threads: int, request_threads: int, loader):
+    from gunicorn.app.base import BaseApplication
+
+    def load():
+        if loader is not None:
+            # Only load the model here, since each worker warms it up anyway
+            loader.load_now()
+        # Move everything loaded so far out of the garbage collector's reach, so that collections in the
+        # workers don't write to (and so copy) the pages holding the model
+        gc.collect()
+        gc.freeze()
+        return app
+
+    def post_fork(server, worker):
+        limit_threads(threads)
+        if loader is not None:
+            # Each worker warms the shared model up in its own process
+            loader.start()
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", bind)
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("threads", request_threads)
+            self.cfg.set("preload_app", True)
+            self.cfg.set("post_fork", post_fork)
+
+        def load(self):
+            return load()
+
+    return Application()
+
+
+def serve(app, port: int, loader=None):
+    host = os.environ.get("MIDAS_HOST", "localhost")
+    workers = int(os.environ.get("MIDAS_WORKERS", 1))
+    threads = int(os.environ.get("MIDAS_THREADS", max(1, (os.cpu_count() or 1) // workers)))
+
+    if workers <= 1:
+        if "MIDAS_THREADS" in os.environ:
+            limit_threads(threads)
+        if loader is not None:
+            loader.start()
+        app.run(host=host, port=port)
+        return
+
+    request_threads = int(os.environ.get("MIDAS_REQUEST_THREADS", 128))
+    _gunicorn_app(app, f"{host}:{port}", workers, threads, request_threads, loader).run()
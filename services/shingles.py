@@ -0,0 +1,81 @@
+"""
+Plans for cutting a document into overlapping shingles for the sentence splitter.
+
+A document of n tokens is wrapped around (its last `stride_size` tokens are put in front of it and
+its first `span_size` tokens after it) and cut into shingles of `span_size` tokens every
+`stride_size` tokens. Each token is then labeled by the shingle in which it is most central.
+All of this only depends on (n, span_size, stride_size), so plans are computed once per shape with
+numpy and memoized.
+"""
+from functools import lru_cache
+from typing import List, NamedTuple
+
+import numpy as np
+
+
+class ShinglePlan(NamedTuple):
+    n: int
+    span_size: int
+    stride_size: int
+    # Number of tokens wrapped around from the end of the document to its front
+    pad: int
+    # Offset of each shingle in the wrapped-around token list
+    starts: np.ndarray
+    # Length of each shingle, which is only less than span_size for very short documents
+    lengths: np.ndarray
+    # For each token, the shingle it is most central in and its position in that shingle
+    shingle: np.ndarray
+    position: np.ndarray
+
+    def dirty(self, begin: int, end: int) -> np.ndarray:
+        """
+        Return a boolean mask over shingles that contain any token in [begin, end), or either of its
+        neighbors, so that shingles spanning an insertion or deletion point are also caught.
+        """
+        lo, hi = max(begin - 1, 0), min(end + 1, self.n)
+        offsets = np.arange(self.span_size)
+        covered = (self.starts[:, np.newaxis] + offsets - self.pad) % max(self.n, 1)
+        inside = (covered >= lo) & (covered < hi) & (offsets < self.lengths[:, np.newaxis])
+        return inside.any(axis=1)
+
+    def shingle_tokens(self, toks: List[str], snums) -> List[List[str]]:
+        """
+        Return the tokens of each of the shingles numbered in `snums`.
+        """
+        wraparound = toks[len(toks) - self.pad:] + toks + toks[: self.span_size]
+        return [wraparound[start : start + self.span_size] for start in self.starts[snums].tolist()]
+
+
+@lru_cache(maxsize=256)
+def plan(n: int, span_size: int, stride_size: int) -> ShinglePlan:
+    if span_size <= stride_size:
+        raise ValueError("span_size must be greater than stride_size, or some tokens would be in no shingle")
+    pad = min(n, stride_size)
+    # Shingles start every stride_size tokens until every token is covered, which for documents of at
+    # least 2 * stride_size - span_size tokens is as soon as they start past the last token
+    starts = np.arange(0, max(n, pad + n - span_size + stride_size), stride_size)
+    lengths = np.minimum(span_size, pad + n + min(n, span_size) - starts)
+
+    # Every shingle that contains token i, as (shingle, first token of the shingle). A token is in at
+    # most ceil(span_size / stride_size) shingles, which are the ones starting at most span_size - 1
+    # tokens before it in the wrapped-around list.
+    tokens = np.arange(n)
+    last = (tokens + pad) // stride_size
+    candidates = last[:, np.newaxis] - np.arange(-(-span_size // stride_size))
+    valid = (candidates >= 0) & (candidates < len(starts))
+    candidates = np.clip(candidates, 0, max(len(starts) - 1, 0))
+    first_token = candidates * stride_size - pad
+    if len(starts) > 0:
+        valid &= tokens[:, np.newaxis] < first_token + lengths[candidates]
+
+    # How far the token is from the center of each shingle, where ties go to the earlier shingle
+    delta = np.abs(2 * first_token + span_size - 2 * tokens[:, np.newaxis]).astype(float)
+    delta[~valid] = np.inf
+    best = delta.shape[1] - 1 - np.argmin(delta[:, ::-1], axis=1)
+    shingle = candidates[tokens, best]
+    position = tokens - first_token[tokens, best]
+
+    result = ShinglePlan(n, span_size, stride_size, pad, starts, lengths, shingle, position)
+    for array in (starts, lengths, shingle, position):
+        array.setflags(write=False)
+    return result
@@ -0,0 +1,87 @@
+"""
+Randomness, latency, and errors for the random stand-in services (random_head.py and
+random_sentence.py), which answer like the sample services without a model so that Midas Loop can be
+load tested on any machine.
+
+Configured with environment variables:
+
+    MIDAS_RANDOM_SEED                   if set, the same input always gets the same probabilities, and
+                                        the sequence of latencies and errors is reproducible
+    MIDAS_RANDOM_LATENCY_MS             time added to every request (default 0)
+    MIDAS_RANDOM_LATENCY_PER_TOKEN_MS   time added for each token in the request (default 0)
+    MIDAS_RANDOM_JITTER                 standard deviation of a log-normal factor that the added time is
+                                        multiplied by, so that some requests are much slower (default 0)
+    MIDAS_RANDOM_ERROR_RATE             fraction of requests that fail (default 0)
+    MIDAS_RANDOM_ERROR_STATUS           status code of failed requests (default 500)
+"""
+import json
+import os
+import random
+import threading
+import time
+import zlib
+from typing import Callable
+
+import numpy as np
+from flask import abort, make_response
+
+SEED = int(os.environ["MIDAS_RANDOM_SEED"]) if os.environ.get("MIDAS_RANDOM_SEED") else None
+# Number of random values drawn up front for each pool
+POOL_SIZE = 1 << 20
+
+
+class DrawPool:
+    """
+    A large batch of random values, drawn once, from which each request takes a window. Drawing
+    values one request at a time would cost more than everything else a stand-in does.
+    """
+
+    def __init__(self, draws: np.ndarray):
+        self.draws = draws
+        self.draws.setflags(write=False)
+
+    def take(self, n: int, *parts: str) -> np.ndarray:
+        """
+        Return a copy of n consecutive values from the pool. If SEED is set, where they start is chosen
+        from a checksum of the request's input `parts`, so that results don't depend on the order
+        requests arrive in; otherwise it is random.
+        """
+        if SEED is None:
+            offset = random.randrange(len(self.draws))
+        else:
+            offset = zlib.crc32("\x00".join(parts).encode("utf-8")) % len(self.draws)
+        if offset + n <= len(self.draws):
+            return self.draws[offset:offset + n].copy()
+        return np.take(self.draws, np.arange(offset, offset + n), mode="wrap")
+
+
+def draw_pool(sample: Callable[[np.random.Generator, int], np.ndarray]) -> DrawPool:
+    """
+    Make a pool of POOL_SIZE values drawn with `sample(generator, size)`.
+    """
+    return DrawPool(sample(np.random.default_rng(SEED), POOL_SIZE))
+
+
+class Profile:
+    def __init__(self):
+        self.latency = float(os.environ.get("MIDAS_RANDOM_LATENCY_MS", 0)) / 1000
+        self.latency_per_token = float(os.environ.get("MIDAS_RANDOM_LATENCY_PER_TOKEN_MS", 0)) / 1000
+        self.jitter = float(os.environ.get("MIDAS_RANDOM_JITTER", 0))
+        self.error_rate = float(os.environ.get("MIDAS_RANDOM_ERROR_RATE", 0))
+        self.error_status = int(os.environ.get("MIDAS_RANDOM_ERROR_STATUS", 500))
+        # Not chosen from the input like the pools' windows, or a request that failed would fail on every retry
+        self._rng = np.random.default_rng(SEED)
+        self._lock = threading.Lock()
+
+    def apply(self, n_tokens: int):
+        """
+        Wait as long as a request of `n_tokens` tokens should take, then fail it if it should fail.
+        """
+        with self._lock:
+            factor = self._rng.lognormal(0.0, self.jitter) if self.jitter > 0 else 1.0
+            fail = self.error_rate > 0 and self._rng.random() < self.error_rate
+        delay = (self.latency + self.latency_per_token * n_tokens) * factor
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            abort(make_response(json.dumps({"error": "Simulated failure"}), self.error_status))
@@ -1,5 +1,6 @@
 (ns midas-loop.server.nlp.http
   (:require [clj-http.client :as client]
+            [clojure.string :as str]
             [clojure.tools.logging :as log]
             [cheshire.core :as json]
             [midas-loop.xtdb.serialization :as serialization]
@@ -10,7 +11,9 @@
             [xtdb.api :as xt]
             [midas-loop.common :as common]
             [midas-loop.xtdb.queries.document :as cxqd]
-            [midas-loop.server.nlp.common :as nlpc]))
+            [midas-loop.server.nlp.common :as nlpc])
+  (:import (java.io ByteArrayOutputStream)
+           (java.util.zip GZIPOutputStream)))
 
 (declare get-probas validate parse-response)
 
@@ -108,7 +111,76 @@
         {:status :ok :data parsed-data}
         {:status :bad-data}))))
 
+;; capabilities
+;; Services may declare at GET /capabilities which request keys they read and whether they accept
+;; gzipped bodies. Services that don't have the route are sent every key, uncompressed.
+(def all-inputs ["conllu" "json" "full_conllu" "sentence_index"])
+;; A service may be redeployed with other capabilities, so they are fetched again once they are
+;; older than *capabilities-ttl-ms*, or after the service gives a non-200 response.
+(def ^:dynamic *capabilities-ttl-ms* (or (:nlp-capabilities-ttl-ms env) 600000))
+;; url -> {:capabilities ... :fetched-at ...}
+(def capabilities-cache (atom {}))
+(defn forget-capabilities
+  "Drop the cached capabilities of the service at url, so that they are fetched again next time."
+  [url]
+  (swap! capabilities-cache dissoc url))
+
+(defn service-capabilities
+  "Return the capabilities declared by the service at url, fetching them if they aren't cached or are
+  older than *capabilities-ttl-ms*. Returns {} for services without a /capabilities route, and nil if
+  the service couldn't be reached or isn't ready, in which case they will be fetched again next time."
+  [url]
+  (let [{:keys [capabilities fetched-at]} (get @capabilities-cache url)]
+    (if (and (some? capabilities)
+             (< (- (System/currentTimeMillis) fetched-at) *capabilities-ttl-ms*))
+      capabilities
+      (let [{:keys [status body]} (try
+                                    (client/get (str (str/replace url #"/+$" "") "/capabilities")
+                                                {:throw-exceptions false})
+                                    (catch Exception e
+                                      (log/debug "Could not fetch capabilities of" url ":" e)
+                                      nil))
+            capabilities (cond (= 200 status) (try (json/parse-string body)
+                                                   (catch Exception e
+                                                     (log/warn "Service at" url "sent malformed capabilities:" e)
+                                                     {}))
+                               (#{404 405} status) {}
+                               :else nil)]
+        (if (some? capabilities)
+          (swap! capabilities-cache assoc url {:capabilities capabilities
+                                               :fetched-at   (System/currentTimeMillis)})
+          (forget-capabilities url))
+        capabilities))))
+
+(defn- gzip-bytes [^String s]
+  (let [out (ByteArrayOutputStream.)]
+    (with-open [gzip (GZIPOutputStream. out)]
+      (.write gzip (.getBytes s "UTF-8")))
+    (.toByteArray out)))
+
+(defn request-body
+  "Make the clj-http options for the body of a request to a service with the given capabilities.
+  `inputs` maps each request key to a function that computes its value, which is only called if the
+  service reads that key."
+  [capabilities inputs]
+  (let [needed (or (seq (get capabilities "inputs")) all-inputs)
+        body (json/generate-string (into {} (for [k needed
+                                                  :let [f (get inputs k)]
+                                                  :when f]
+                                              [k (f)])))]
+    (if (some #{"gzip"} (get capabilities "content_encodings"))
+      {:body (gzip-bytes body) :headers {"Content-Encoding" "gzip"}}
+      {:body body})))
+
 (def ^:dynamic *retry-wait-period* (or (:nlp-retry-wait-period-ms env) 10000))
+(defn retry-wait-ms
+  "How long to wait before retrying after a non-200 response: the service's Retry-After estimate
+  (in seconds) if it sent one, and *retry-wait-period* otherwise."
+  [{:keys [headers]}]
+  (if-let [seconds (some-> (get headers "Retry-After") str parse-long)]
+    (* 1000 seconds)
+    *retry-wait-period*))
+
 (defn get-probas
   "Attempt to contact an NLP service, defensively dealing with request failures and bad data"
   [node url anno-type sentence-id]
@@ -126,16 +198,21 @@
                                ;; (nil? head) ...
                                (= sentence-id head) i
                                :else (recur rest (inc i))))
-            {:keys [status body]}
+            capabilities (service-capabilities url)
+            {:keys [status body] :as response}
             (try
               ;; Parse the body manually later
               (binding [client/*current-middleware* (filterv #(not= % client/wrap-output-coercion) client/default-middleware)]
-                (client/post url {:form-params   {:conllu         (.toString (serialization/serialize-sentence node sentence-id))
-                                                  :json           (cxq/pull2 node :sentence/id sentence-id)
-                                                  :full_conllu    (.toString (serialization/serialize-document node document-id))
-                                                  :sentence_index sentence-index}
-                                  :content-type  :json
-                                  :retry-handler retry}))
+                (client/post url (merge (request-body
+                                          capabilities
+                                          {"conllu"         #(.toString (serialization/serialize-sentence node sentence-id))
+                                           "json"           #(cxq/pull2 node :sentence/id sentence-id)
+                                           "full_conllu"    #(.toString (serialization/serialize-document node document-id))
+                                           "sentence_index" (constantly sentence-index)})
+                                        {:content-type  :json
+                                         ;; Return non-200 responses rather than throwing, so their Retry-After can be read
+                                         :throw-exceptions false
+                                         :retry-handler retry})))
               (catch Exception e
                 (do
                   (log/error "Exception thrown while attempting to contact NLP service:" e)
@@ -146,9 +223,11 @@
               (recur)
 
               (not= 200 status)
-              (do
-                (log/info "Service at" url "gave non-200 response code" status "-- retrying...")
-                (Thread/sleep *retry-wait-period*)
+              (let [wait-ms (retry-wait-ms response)]
+                (log/info "Service at" url "gave non-200 response code" status "-- retrying in" wait-ms "ms...")
+                ;; e.g. a 400 because the service was redeployed and now reads a key we don't send
+                (forget-capabilities url)
+                (Thread/sleep wait-ms)
                 (recur))
 
               :else
@@ -0,0 +1,100 @@
+(ns midas-loop.server.nlp.http-test
+  (:require [clojure.test :refer :all]
+            [clj-http.client :as client]
+            [cheshire.core :as json]
+            [midas-loop.server.nlp.http :as http])
+  (:import (java.io ByteArrayInputStream)
+           (java.util.zip GZIPInputStream)))
+
+(use-fixtures
+  :each
+  (fn [f]
+    (reset! http/capabilities-cache {})
+    (f)
+    (reset! http/capabilities-cache {})))
+
+(defn- gunzip [^bytes bs]
+  (slurp (GZIPInputStream. (ByteArrayInputStream. bs)) :encoding "UTF-8"))
+
+(def inputs {"conllu"         (constantly "1\tfoo\t_\t_\t_\t_\t_\t_\t_\t_\n")
+             "json"           (constantly {"sentence/id" "s1"})
+             "full_conllu"    (constantly "1\tfoo\t_\t_\t_\t_\t_\t_\t_\t_\n")
+             "sentence_index" (constantly 0)})
+
+(deftest test-request-body
+  (testing "services without capabilities are sent every key, uncompressed"
+    (let [{:keys [body headers]} (http/request-body {} inputs)]
+      (is (= #{"conllu" "json" "full_conllu" "sentence_index"} (set (keys (json/parse-string body)))))
+      (is (nil? headers))))
+
+  (testing "only the declared inputs are computed and sent"
+    (let [inputs (assoc inputs "full_conllu" #(throw (ex-info "full_conllu should not be computed" {})))
+          {:keys [body]} (http/request-body {"inputs" ["conllu" "sentence_index"]} inputs)]
+      (is (= {"conllu" "1\tfoo\t_\t_\t_\t_\t_\t_\t_\t_\n" "sentence_index" 0} (json/parse-string body)))))
+
+  (testing "bodies are gzipped for services that accept it"
+    (let [{:keys [body headers]} (http/request-body {"inputs" ["sentence_index"] "content_encodings" ["gzip"]} inputs)]
+      (is (= {"Content-Encoding" "gzip"} headers))
+      (is (= {"sentence_index" 0} (json/parse-string (gunzip body)))))))
+
+(deftest test-retry-wait-ms
+  (binding [http/*retry-wait-period* 1234]
+    (testing "Retry-After is read as seconds"
+      (is (= 3000 (http/retry-wait-ms {:status 429 :headers {"Retry-After" "3"}}))))
+    (testing "the default wait is used without a usable Retry-After"
+      (is (= 1234 (http/retry-wait-ms {:status 500 :headers {}})))
+      (is (= 1234 (http/retry-wait-ms {:status 503 :headers {"Retry-After" "soon"}}))))))
+
+(defn- counting-get
+  "A stand-in for client/get that answers with each of responses in turn, recording the calls in calls."
+  [calls responses]
+  (fn [url & _]
+    (let [i (count (swap! calls conj url))]
+      (nth responses (dec i) (last responses)))))
+
+(def url "http://localhost:5555/")
+
+(deftest test-service-capabilities
+  (testing "capabilities are fetched once and then cached"
+    (let [calls (atom [])]
+      (with-redefs [client/get (counting-get calls [{:status 200 :body "{\"inputs\": [\"conllu\"]}"}])]
+        (is (= {"inputs" ["conllu"]} (http/service-capabilities url)))
+        (is (= {"inputs" ["conllu"]} (http/service-capabilities url)))
+        (is (= ["http://localhost:5555/capabilities"] @calls)))))
+
+  (testing "services without the route have no capabilities"
+    (let [calls (atom [])]
+      (with-redefs [client/get (counting-get calls [{:status 404 :body ""}])]
+        (http/forget-capabilities url)
+        (is (= {} (http/service-capabilities url)))
+        (is (= {} (http/service-capabilities url)))
+        (is (= 1 (count @calls))))))
+
+  (testing "capabilities are fetched again after they are forgotten"
+    (let [calls (atom [])]
+      (with-redefs [client/get (counting-get calls [{:status 200 :body "{\"inputs\": [\"conllu\"]}"}
+                                                    {:status 200 :body "{\"inputs\": [\"json\"]}"}])]
+        (http/forget-capabilities url)
+        (is (= {"inputs" ["conllu"]} (http/service-capabilities url)))
+        (http/forget-capabilities url)
+        (is (= {"inputs" ["json"]} (http/service-capabilities url)))
+        (is (= 2 (count @calls))))))
+
+  (testing "capabilities are fetched again once they are older than the TTL"
+    (let [calls (atom [])]
+      (with-redefs [client/get (counting-get calls [{:status 200 :body "{\"inputs\": [\"conllu\"]}"}
+                                                    {:status 200 :body "{\"inputs\": [\"json\"]}"}])]
+        (http/forget-capabilities url)
+        (binding [http/*capabilities-ttl-ms* 0]
+          (is (= {"inputs" ["conllu"]} (http/service-capabilities url)))
+          (is (= {"inputs" ["json"]} (http/service-capabilities url))))
+        (is (= 2 (count @calls))))))
+
+  (testing "failed fetches are not cached"
+    (let [calls (atom [])]
+      (with-redefs [client/get (counting-get calls [{:status 500 :body ""}
+                                                    {:status 200 :body "{\"inputs\": [\"conllu\"]}"}])]
+        (http/forget-capabilities url)
+        (is (nil? (http/service-capabilities url)))
+        (is (= {"inputs" ["conllu"]} (http/service-capabilities url)))
+        (is (= 2 (count @calls)))))))